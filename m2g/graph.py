@@ -13,10 +13,12 @@ import csv
 
 # standard library imports
 import os
+import pickle
+import shutil
 import time
 from collections import defaultdict
-from functools import reduce
-from itertools import combinations
+from itertools import combinations, islice
+from operator import add
 from pathlib import Path
 
 import matplotlib
@@ -27,6 +29,9 @@ import nibabel as nib
 import numpy as np
 from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
 from joblib import Parallel, delayed
+from nibabel.streamlines import ArraySequence
+from scipy.ndimage import distance_transform_edt
+from scipy.sparse import coo_matrix, csr_matrix, save_npz, triu
 
 from m2g.utils.gen_utils import timer
 
@@ -36,6 +41,559 @@ from graspologic.utils import ptr
 from matplotlib import pyplot as plt
 
 
+def _label_lut(rois, attr):
+    """Maps every voxel of an ROI volume onto a contiguous node index
+
+    Node indices follow the sorted unique labels of the unregistered atlas, so node 0 is background.
+    Voxels that are background (or carry a label missing from the atlas) are set to -1.
+
+    Parameters
+    ----------
+    rois : ndarray
+        Integer label volume aligned to the streamlines
+    attr : ndarray
+        Integer label volume of the atlas before registration
+
+    Returns
+    -------
+    ndarray
+        int32 volume of node indices, same shape as rois
+    int
+        Number of nodes in the graph
+    """
+    labels = np.unique(attr)
+    mx = len(labels)
+
+    lo = min(labels.min(), rois.min())
+    lut = np.full(max(labels.max(), rois.max()) - lo + 1, -1, dtype=np.int32)
+    lut[labels - lo] = np.arange(mx, dtype=np.int32)
+    lut[labels[labels <= 0] - lo] = -1
+
+    return lut[rois - lo], mx
+
+
+def _dilate_nodes(node_vol, error_margin, voxel_size):
+    """Grows every roi into the surrounding background, up to error_margin mm away
+
+    Each background voxel within the margin takes the node of its nearest labelled voxel, so a streamline
+    point is assigned to an roi with a single lookup instead of a search over a sphere around it.
+
+    Parameters
+    ----------
+    node_vol : ndarray
+        Volume of node indices, -1 outside of every roi
+    error_margin : float
+        Distance in mm within which background voxels join their nearest roi
+    voxel_size : float or sequence
+        Voxel size in mm, either isotropic or one value per axis
+
+    Returns
+    -------
+    ndarray
+        Volume of node indices with the rois dilated, same shape and dtype as node_vol
+    """
+    background = node_vol < 0
+    if error_margin <= 0 or background.all() or not background.any():
+        return node_vol
+
+    dist, inds = distance_transform_edt(
+        background, sampling=voxel_size, return_indices=True
+    )
+    dilated = node_vol[tuple(inds)]
+    dilated[dist > error_margin] = -1
+    return dilated
+
+
+def _flat_points(tracks):
+    """Returns the point buffer of a set of streamlines without copying it when possible
+
+    Parameters
+    ----------
+    tracks : ArraySequence or list
+        Streamlines to flatten
+
+    Returns
+    -------
+    ndarray
+        (N, 3) array with the points of every streamline, in streamline order
+    ndarray
+        Number of points in each streamline
+    """
+    if not isinstance(tracks, ArraySequence):
+        tracks = ArraySequence(tracks)
+
+    lengths = np.asarray(tracks._lengths, dtype=np.int64)
+    offsets = np.asarray(tracks._offsets, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    total = int(lengths.sum())
+
+    data = tracks._data.reshape(-1, 3)
+    if np.array_equal(offsets, starts):
+        points = data[:total]
+    else:  # sliced sequences point into a shared buffer
+        points = data[np.repeat(offsets - starts, lengths) + np.arange(total)]
+    return points, lengths
+
+
+def _trk_batches(trk_file, chunk_size):
+    """Reads a .trk file lazily, yielding its streamlines in fixed-size batches
+
+    Parameters
+    ----------
+    trk_file : str
+        Path to the streamlines file
+    chunk_size : int
+        Number of streamlines per batch
+
+    Yields
+    ------
+    ndarray
+        (N, 3) point buffer of the batch
+    ndarray
+        Point offsets of each streamline in the batch, with the total number of points appended
+    """
+    streamlines = iter(nib.streamlines.load(str(trk_file), lazy_load=True).streamlines)
+    while True:
+        batch = ArraySequence(islice(streamlines, chunk_size))
+        if len(batch) == 0:
+            return
+        points, lengths = _flat_points(batch)
+        yield points, np.concatenate([[0], np.cumsum(lengths)])
+
+
+def _streamline_visits(points, lengths, shape):
+    """Finds the voxels that each streamline passes through, and how many of its points fall in each
+
+    This only depends on the streamlines, so it can be shared by every parcellation aligned to the same space.
+
+    Parameters
+    ----------
+    points : ndarray
+        (N, 3) flat point buffer of the streamlines
+    lengths : ndarray
+        Number of points in each streamline
+    shape : tuple
+        Shape of the label volumes the streamlines are in
+
+    Returns
+    -------
+    ndarray
+        Streamline index of each visit, sorted
+    ndarray
+        Flat (C-order) voxel index of each visit, ascending within a streamline
+    ndarray
+        Number of points of the streamline inside that voxel
+    """
+    if len(points) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    lin_T, offset = _mapping_to_voxel(np.eye(4))
+    vox = np.ravel_multi_index(_to_voxel_coordinates(points, lin_T, offset).T, shape)
+    sids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+
+    nvox = int(np.prod(shape))
+    keys, counts = np.unique(sids * nvox + vox, return_counts=True)
+    return keys // nvox, keys % nvox, counts
+
+
+def _visit_nodes(sids, vox, counts, node_vol, overlap_thr=1):
+    """Finds the nodes that each streamline passes through from its voxel visits
+
+    Parameters
+    ----------
+    sids, vox, counts : ndarray
+        Voxel visits from `_streamline_visits`
+    node_vol : ndarray
+        Node index volume from `_label_lut`
+    overlap_thr : int, optional
+        Minimum number of points a streamline must have in a node to count it, by default 1
+
+    Returns
+    -------
+    ndarray
+        Streamline index of each (streamline, node) pair, sorted
+    ndarray
+        Node index of each (streamline, node) pair, ascending within a streamline
+    """
+    nodes = node_vol.ravel()[vox].astype(np.int64)
+    inside = nodes >= 0
+
+    mx = max(int(node_vol.max()) + 1, 1)
+    keys, inv = np.unique(sids[inside] * mx + nodes[inside], return_inverse=True)
+    totals = np.bincount(inv.ravel(), weights=counts[inside], minlength=len(keys))
+    keys = keys[totals >= overlap_thr]
+    return keys // mx, keys % mx
+
+
+def _label_pairs(sids, nodes):
+    """Expands the nodes of each streamline into every pair of nodes it connects
+
+    Equivalent to `itertools.combinations(nodes, 2)` per streamline, using offset arithmetic over the whole batch.
+
+    Parameters
+    ----------
+    sids : ndarray
+        Sorted streamline index of each (streamline, node) pair
+    nodes : ndarray
+        Node index of each (streamline, node) pair
+
+    Returns
+    -------
+    ndarray
+        Lower node index of each edge
+    ndarray
+        Higher node index of each edge
+    """
+    # number of later entries sharing the same streamline, for every entry
+    ends = np.searchsorted(sids, sids, side="right")
+    n_later = ends - np.arange(len(sids)) - 1
+
+    first = np.repeat(np.arange(len(sids)), n_later)
+    starts = np.cumsum(n_later) - n_later
+    second = first + 1 + np.arange(len(first)) - np.repeat(starts, n_later)
+    return nodes[first], nodes[second]
+
+
+def _visit_connectomes(visits, node_vols, overlap_thr):
+    """Counts the edges of every parcellation from a batch of voxel visits
+
+    Parameters
+    ----------
+    visits : tuple
+        (sids, vox, counts) voxel visits from `_streamline_visits`
+    node_vols : list
+        (node index volume, number of nodes) pairs from `GraphTools.node_volume`
+    overlap_thr : int
+        Minimum number of points a streamline must have in a node to count it
+
+    Returns
+    -------
+    list
+        Upper-triangular CSR edge count matrix for each parcellation
+    """
+    conns = []
+    for node_vol, mx in node_vols:
+        sids, nodes = _visit_nodes(*visits, node_vol, overlap_thr)
+        rows, cols = _label_pairs(sids, nodes)
+
+        # duplicate (row, col) entries are summed when converting to CSR
+        weights = np.ones(len(rows))
+        conns.append(coo_matrix((weights, (rows, cols)), shape=(mx, mx)).tocsr())
+    return conns
+
+
+def _connectome_worker(points, offsets, start, stop, shape, node_vols, overlap_thr):
+    """Counts the edges of every parcellation for a contiguous range of streamlines
+
+    Parameters
+    ----------
+    points : ndarray
+        (N, 3) flat point buffer of all the streamlines (usually a read-only memmap)
+    offsets : ndarray
+        Index of the first point of each streamline in points, followed by N
+    start, stop : int
+        Range of streamlines to process
+    shape : tuple
+        Shape of the label volumes
+    node_vols : list
+        (node index volume, number of nodes) pairs from `GraphTools.node_volume`
+    overlap_thr : int
+        Minimum number of points a streamline must have in a node to count it
+
+    Returns
+    -------
+    list
+        Upper-triangular CSR edge count matrix for each parcellation
+    """
+    lengths = np.diff(offsets[start : stop + 1])
+    points = points[offsets[start] : offsets[stop]]
+    visits = _streamline_visits(points, lengths, shape)
+    return _visit_connectomes(visits, node_vols, overlap_thr)
+
+
+def _index_worker(offsets, vox, counts, start, stop, node_vols, overlap_thr):
+    """Counts the edges of every parcellation for a contiguous range of streamlines of a visit index
+
+    Parameters
+    ----------
+    offsets, vox, counts : ndarray
+        One chunk of a CSR visit index from `load_visit_index`
+    start, stop : int
+        Range of streamlines to process
+    node_vols : list
+        (node index volume, number of nodes) pairs from `GraphTools.node_volume`
+    overlap_thr : int
+        Minimum number of points a streamline must have in a node to count it
+
+    Returns
+    -------
+    list
+        Upper-triangular CSR edge count matrix for each parcellation
+    """
+    lo, hi = offsets[start], offsets[stop]
+    n_visits = np.diff(offsets[start : stop + 1]).astype(np.int64)
+    sids = np.repeat(np.arange(stop - start, dtype=np.int64), n_visits)
+    visits = (sids, vox[lo:hi].astype(np.int64), counts[lo:hi])
+    return _visit_connectomes(visits, node_vols, overlap_thr)
+
+
+def _index_chunk(points, offsets, start, stop, shape):
+    """Builds the CSR visit index entries of a contiguous range of streamlines
+
+    Parameters
+    ----------
+    points : ndarray
+        (N, 3) flat point buffer of all the streamlines (usually a read-only memmap)
+    offsets : ndarray
+        Index of the first point of each streamline in points, followed by N
+    start, stop : int
+        Range of streamlines to process
+    shape : tuple
+        Shape of the label volumes
+
+    Returns
+    -------
+    ndarray
+        Number of voxels visited by each streamline
+    ndarray
+        uint32 flat voxel index of each visit
+    ndarray
+        uint32 number of points of the streamline inside that voxel
+    """
+    lengths = np.diff(offsets[start : stop + 1])
+    points = points[offsets[start] : offsets[stop]]
+    sids, vox, counts = _streamline_visits(points, lengths, shape)
+    n_visits = np.bincount(sids, minlength=stop - start)
+    return n_visits, vox.astype(np.uint32), counts.astype(np.uint32)
+
+
+def _chunk_bounds(nlines, chunk_size, n_cpus):
+    """Splits nlines streamlines into contiguous ranges, at least one per cpu and at most chunk_size long"""
+    n_chunks = max(n_cpus, int(np.ceil(nlines / chunk_size)))
+    bounds = np.linspace(0, nlines, n_chunks + 1).astype(int)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _streamline_tasks(worker, tracks, chunk_size, n_cpus, *args):
+    """Yields one joblib task per chunk of streamlines, calling worker(points, offsets, start, stop, *args)
+
+    Parameters
+    ----------
+    worker : callable
+        Function to run on each chunk
+    tracks : ArraySequence, list or str
+        Streamlines in memory, or the path to a .trk file
+    chunk_size : int
+        Maximum number of streamlines per chunk
+    n_cpus : int
+        Number of workers the chunks are spread over
+    *args
+        Extra arguments passed to worker
+
+    Yields
+    ------
+    tuple
+        Delayed call of worker on a chunk
+    """
+    if isinstance(tracks, (str, Path)):
+        # Stream the tractogram from disk; joblib only reads ahead a few batches, so memory stays bounded
+        for points, offsets in _trk_batches(tracks, chunk_size):
+            yield delayed(worker)(points, offsets, 0, len(offsets) - 1, *args)
+    else:
+        # Flat point buffer and label volumes are handed to joblib as plain arrays, which it dumps to a
+        # memmap once and shares read-only with every worker. Workers then get contiguous streamline ranges.
+        points, lengths = _flat_points(tracks)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        for start, stop in _chunk_bounds(len(lengths), chunk_size, n_cpus):
+            yield delayed(worker)(points, offsets, start, stop, *args)
+
+
+def _n_streamlines(tracks):
+    """Number of streamlines in memory or in a .trk file, without loading the file"""
+    if isinstance(tracks, (str, Path)):
+        header = nib.streamlines.load(str(tracks), lazy_load=True).header
+        return int(header["nb_streamlines"])
+    return len(tracks)
+
+
+def _index_chunk_files(index_file, chunk):
+    """Paths of the offsets, vox and counts arrays of one chunk of a visit index"""
+    chunk_dir = os.path.splitext(index_file)[0]
+    return [
+        os.path.join(chunk_dir, f"{chunk:05d}_{name}.npy")
+        for name in ["offsets", "vox", "counts"]
+    ]
+
+
+@timer
+def write_visit_index(tracks, shape, index_file, n_cpus=1, chunk_size=100000):
+    """Records the voxels visited by each streamline, and how many of its points fall in each, as a CSR index.
+    The index only depends on the streamlines and the volume shape, so any parcellation, error margin or overlap
+    threshold can later be evaluated from it (see `make_graphs`) without mapping the streamlines again.
+    Each chunk of streamlines is saved as soon as it is mapped, so memory stays bounded by the chunk size.
+
+    Parameters
+    ----------
+    tracks : ArraySequence, list or str
+        Streamlines in voxel coordinates, or the path to a .trk file (read in chunks)
+    shape : tuple
+        Shape of the label volumes the streamlines are in
+    index_file : str
+        Path of the .npz file to write, usually next to streamlines.trk. The chunks are saved as .npy files
+        in a directory of the same name, without the extension.
+    n_cpus : int, optional
+        Number of cpus to use, by default 1
+    chunk_size : int, optional
+        Maximum number of streamlines a worker processes at a time, by default 100000
+
+    Returns
+    -------
+    str
+        Path to the index file, with arrays shape and n_streamlines (number of streamlines in each chunk)
+    """
+    shape = tuple(int(x) for x in shape)
+    chunk_dir = os.path.splitext(index_file)[0]
+    if os.path.isdir(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+
+    tasks = _streamline_tasks(_index_chunk, tracks, chunk_size, n_cpus, shape)
+    chunks = Parallel(n_jobs=n_cpus, mmap_mode="r", return_as="generator")(tasks)
+    n_streamlines = []
+    for chunk, (n_visits, vox, counts) in enumerate(chunks):
+        offsets = np.concatenate([[0], np.cumsum(n_visits)])
+        offsets = offsets.astype(np.uint32 if offsets[-1] < 2**32 else np.uint64)
+        for path, arr in zip(
+            _index_chunk_files(index_file, chunk), [offsets, vox, counts]
+        ):
+            np.save(path, arr)
+        n_streamlines.append(len(n_visits))
+
+    np.savez(index_file, shape=shape, n_streamlines=np.array(n_streamlines, int))
+    print(f"Visit index for {sum(n_streamlines)} streamlines saved to {index_file}")
+    return index_file
+
+
+def load_visit_index(index_file):
+    """Opens a visit index written by `write_visit_index`. The arrays are memory-mapped, and only read as
+    each chunk is used.
+
+    Parameters
+    ----------
+    index_file : str
+        Path to the .npz index
+
+    Returns
+    -------
+    list
+        (offsets, vox, counts) read-only memmaps for each chunk of streamlines, in streamline order.
+        offsets holds the index of the first visit of each streamline of the chunk, followed by the number of
+        visits in the chunk, vox the flat voxel index of each visit, and counts the number of points of the
+        streamline inside that voxel.
+    tuple
+        Shape of the volume the voxel indices refer to
+    """
+    with np.load(index_file) as index:
+        shape = tuple(int(x) for x in index["shape"])
+        n_chunks = len(index["n_streamlines"])
+    chunks = [
+        tuple(
+            np.load(path, mmap_mode="r")
+            for path in _index_chunk_files(index_file, chunk)
+        )
+        for chunk in range(n_chunks)
+    ]
+    return chunks, shape
+
+
+GRAPH_FORMATS = {
+    "igraph": ".csv",
+    "edgelist": ".csv",
+    "npz": ".npz",
+    "npy": ".npy",
+    "txt": ".txt",
+    "graphml": ".graphml",
+    "gpickle": ".gpickle",
+}
+
+
+def save_connectome(conn_matrix, graphname, fmt="igraph"):
+    """Writes a connectome adjacency matrix to disk in one or more formats.
+    networkx is only used for the formats that need a graph object (graphml, gpickle).
+
+    Parameters
+    ----------
+    conn_matrix : ndarray or sparse matrix
+        Symmetric (n_nodes, n_nodes) adjacency matrix, node i being row i
+    graphname : str
+        Filename for the graph. When several formats are requested, its extension is replaced by the one of each format
+    fmt : str or list, optional
+        Format(s) to save the graph as [edgelist, igraph, npz, npy, txt, graphml, gpickle], by default "igraph".
+        edgelist and igraph are both "u v weight" lines over the upper triangle, npz is a compressed scipy sparse matrix
+
+    Returns
+    -------
+    list
+        Paths of the files written
+
+    Raises
+    ------
+    ValueError
+        Unsupported format
+    FileNotFoundError
+        A file was not created
+    """
+    fmts = [fmt] if isinstance(fmt, str) else list(fmt)
+    unknown = set(fmts) - set(GRAPH_FORMATS)
+    if unknown:
+        raise ValueError(
+            f"Unsupported format(s) {sorted(unknown)}, choose from {list(GRAPH_FORMATS)}"
+        )
+
+    conn_matrix = csr_matrix(conn_matrix)
+    conn_matrix.sum_duplicates()
+    conn_matrix.sort_indices()
+
+    outputs = []
+    for f in fmts:
+        outf = graphname
+        if len(fmts) > 1:
+            outf = os.path.splitext(graphname)[0] + GRAPH_FORMATS[f]
+
+        if f in ("edgelist", "igraph"):
+            upper = triu(conn_matrix, format="coo")
+            lines = np.char.add(
+                np.char.add(upper.row.astype(str), " "),
+                np.char.add(
+                    np.char.add(upper.col.astype(str), " "), upper.data.astype(str)
+                ),
+            )
+            with open(outf, "w", encoding="utf-8") as out:
+                out.writelines(np.char.add(lines, "\n"))
+        elif f == "npz":
+            with open(outf, "wb") as out:
+                save_npz(out, conn_matrix)
+        elif f == "npy":
+            with open(outf, "wb") as out:
+                np.save(out, conn_matrix.toarray())
+        elif f == "txt":
+            np.savetxt(outf, conn_matrix.toarray())
+        else:
+            g = nx.from_scipy_sparse_array(conn_matrix)
+            if f == "graphml":
+                nx.write_graphml(g, outf)
+            else:
+                with open(outf, "wb") as out:
+                    pickle.dump(g, out, pickle.HIGHEST_PROTOCOL)
+
+        if not os.path.isfile(outf):
+            raise FileNotFoundError(f"File {outf} not created.")
+        outputs.append(outf)
+
+    return outputs
+
+
 class GraphTools:
     """Initializes the graph with nodes corresponding to the number of ROIS
 
@@ -43,8 +601,9 @@ class GraphTools:
     ----------
     rois : ndarray
         ROIs as array
-    tracks : list
-        Streamlines for analysis
+    tracks : list or str
+        Streamlines for analysis, the path to a saved .trk file that is read in chunks, or the path to a .npz
+        visit index from `write_visit_index`
     affine : ndarray
         a 2-D array with ones on the diagonal and zeros elsewhere (DOESN'T APPEAR TO BE Used)
     outdir : Path
@@ -92,6 +651,8 @@ class GraphTools:
         self.connectome_path = os.path.dirname(connectome_path)
         self.attr = attr
         self.n_cpus = int(n_cpus)
+        self.conn_matrix = None
+        self._node_vols = {}
 
     @timer
     def make_graph_old(self):
@@ -145,150 +706,87 @@ class GraphTools:
         return self.g, self.edge_dict
 
     @timer
-    def make_graph(self, error_margin=2, overlap_thr=1, voxel_size=2):
+    def make_graph(self, error_margin=0, overlap_thr=1, voxel_size=2):
         """Takes streamlines and produces a graph using Numpy functions
 
         Parameters
         ----------
         error_margin : int, optional
-            Number of mm around roi's to use (i.e. if 2, then any voxel within 2 mm of roi is considered part of roi), by default 2
+            Number of mm around roi's to use (i.e. if 2, then any background voxel within 2 mm of an roi is considered part of
+            the nearest roi, so streamlines ending just outside an roi still count as reaching it). 0 uses the roi voxels only,
+            by default 0
         overlap_thr : int, optional
             The amount of overlap between an roi and streamline to be considered a connection, by default 1
-        voxel_size : int, optional
-            Voxel size for roi/streamlines, by default 2
+        voxel_size : int or sequence, optional
+            Voxel size in mm for roi/streamlines, isotropic or per axis, by default 2
 
         Returns
         -------
         Graph
             networkx Graph object containing the connectome matrix
         """
-        print("Building connectivity matrix...")
+        make_graphs([self], error_margin, overlap_thr, voxel_size)
+        self.g = nx.from_scipy_sparse_array(self.conn_matrix)
+        return self.g
+
+    def node_volume(self, error_margin=0, voxel_size=2):
+        """Loads the atlas labels, records any roi lost during registration, and maps the roi volume onto node indices.
+        The result is cached per error margin, so repeated graphs from the same parcellation skip the dilation.
+
+        Parameters
+        ----------
+        error_margin : int, optional
+            Number of mm around roi's to use (i.e. if 2, then any voxel within 2 mm of roi is considered part of roi), by default 0
+        voxel_size : int or sequence, optional
+            Voxel size in mm for roi/streamlines, isotropic or per axis, by default 2
 
-        # Instantiate empty networkX graph object & dictionary
-        # Create voxel-affine mapping
-        lin_T, offset = _mapping_to_voxel(
-            np.eye(4)
-        )  # TODO : voxel_size was removed in dipy 1.0.0, make sure that didn't break anything when voxel size is not 2mm
+        Returns
+        -------
+        ndarray
+            int32 volume of node indices aligned to the streamlines, -1 outside of every roi
+        int
+            Number of nodes in the graph
+        """
+        key = (error_margin, tuple(np.broadcast_to(voxel_size, 3).tolist()))
+        if key in self._node_vols:
+            return self._node_vols[key]
 
-        self.attr = nib.load(self.attr)
-        self.attr = self.attr.get_data().astype("int")
+        attr = nib.load(self.attr)
+        attr = attr.get_data().astype("int")
 
-        mx = len(np.unique(self.attr.astype(np.int64)))
-        # node_dict = dict(
-        #    zip(np.unique(self.rois).astype("int16") + 1, np.arange(mx) + 1)
-        # )
-        node_dict = dict(zip(np.unique(self.attr).astype("int16"), np.arange(mx)))
+        # Contiguous label -> node index lookup, applied to the whole ROI volume once
+        node_vol, mx = _label_lut(self.rois, attr)
 
-        lost_rois = []
         # Track lost rois
-        for un in np.unique(self.attr.astype(np.int64)):
-            if un not in self.rois:
-                lost_rois.append(un)
+        lost_rois = np.setdiff1d(np.unique(attr), np.unique(self.rois))
 
         if len(lost_rois) > 0:
             with open(f"{self.connectome_path}/lost_roi.csv", mode="w") as lost_file:
                 lost_writer = csv.writer(lost_file, delimiter=",")
                 lost_writer.writerow(lost_rois)
 
-        nlines = len(self.tracks)
-        print("# of Streamlines: " + str(nlines))
-
-        def worker(tracks):
-            g = nx.Graph(ecount=0, vcount=mx)
-            # Add empty vertices
-            nodelist = list(range(0, mx))
-            for node in nodelist:  # (1, mx + 1):
-                g.add_node(node)
-
-            edge_dict = defaultdict(int)
-            for s in tracks:
-                # Map the streamlines coordinates to voxel coordinates and get labels for label_volume
-                # i, j, k = np.vstack(np.array([get_sphere(coord, error_margin,
-                #                                          (voxel_size, voxel_size, voxel_size),
-                #                                          self.roi_img.shape) for coord in
-                #                               _to_voxel_coordinates(s, lin_T, offset)])).T
-
-                # Map the streamlines coordinates to voxel coordinates
-                points = _to_voxel_coordinates(s, lin_T, offset)
-
-                # get labels for label_volume
-                i, j, k = points.T
-
-                lab_arr = self.rois[i, j, k]
-                endlabels = []
-                for lab in np.unique(lab_arr).astype("int16"):
-                    if (lab > 0) and (np.sum(lab_arr == lab) >= overlap_thr):
-                        endlabels.append(node_dict[lab])
-                endlabels = sorted(endlabels)
-
-                edges = combinations(endlabels, 2)
-                for edge in edges:
-                    edge_dict[edge] += 1
-
-            edge_list = [(k[0], k[1], v) for k, v in edge_dict.items()]
-            g.add_weighted_edges_from(edge_list)
-            A = nx.to_numpy_array(g, nodelist=nodelist)
-            return A
-
-        res = Parallel(n_jobs=self.n_cpus)(
-            delayed(worker)(self.tracks[start :: self.n_cpus])
-            for start in range(self.n_cpus)
-        )
-        conn_matrix = reduce(np.add, res)
-
-        # These steps are not needed.
-        # conn_matrix = np.array(nx.to_numpy_matrix(self.g))
-        # conn_matrix[np.isnan(conn_matrix)] = 0
-        # conn_matrix[np.isinf(conn_matrix)] = 0
-        # conn_matrix = np.asmatrix(np.maximum(conn_matrix, conn_matrix.transpose()))
-        g = nx.from_numpy_matrix(conn_matrix)
-
-        return g
+        node_vol = _dilate_nodes(node_vol, error_margin, voxel_size)
+        self._node_vols[key] = node_vol, mx
+        return node_vol, mx
 
     def save_graph(self, graphname, fmt="igraph"):
-        """Saves the graph to disk
+        """Saves the graph to disk, straight from its adjacency matrix
 
         Parameters
         ----------
         graphname : str
             Filename for the graph
-        fmt : str, optional
-            Format you want the graph saved as [edgelist, gpickle, graphml, txt, npy, igraph], by default "igraph"
+        fmt : str or list, optional
+            Format(s) you want the graph saved as [edgelist, gpickle, graphml, txt, npy, npz, igraph], by default "igraph".
+            See `save_connectome` for the filenames used when saving several formats.
 
         Raises
         ------
-        ValueError
-            Unsupported modality (not dwi or func) for saving the graph in igraph format
         ValueError
             Unsupported format
         """
-
-        self.g.graph["ecount"] = nx.number_of_edges(self.g)
-        self.g = nx.convert_node_labels_to_integers(self.g, first_label=0)
-        print(self.g.graph)
-        if fmt == "edgelist":
-            nx.write_weighted_edgelist(self.g, graphname, encoding="utf-8")
-        elif fmt == "gpickle":
-            nx.write_gpickle(self.g, graphname)
-        elif fmt == "graphml":
-            nx.write_graphml(self.g, graphname)
-        elif fmt == "txt":
-            np.savetxt(graphname, nx.to_numpy_matrix(self.g))
-        elif fmt == "npy":
-            np.save(graphname, nx.to_numpy_matrix(self.g))
-        elif fmt == "igraph":
-            nx.write_weighted_edgelist(
-                self.g, graphname, delimiter=" ", encoding="utf-8"
-            )
-        else:
-            raise ValueError(
-                "Only edgelist, gpickle, graphml, txt, and npy are currently supported"
-            )
-
-        if not os.path.isfile(graphname):
-            raise FileNotFoundError(f"File {graphname} not created.")
-
-        print(f"Graph saved. Output location here: {graphname}")
+        for outf in save_connectome(self.adjacency(), graphname, fmt):
+            print(f"Graph saved. Output location here: {outf}")
 
     def save_graph_png(self, qa_dir, graphname):
         """Saves adjacency graph, made using graspy's heatmap function, as a png. This will be saved in the qa/graphs_plotting/ directory
@@ -299,7 +797,7 @@ class GraphTools:
             name of the generated graph (do not include '.png')
         """
 
-        conn_matrix = np.array(nx.to_numpy_matrix(self.g))
+        conn_matrix = self.adjacency().toarray()
         conn_matrix = ptr.pass_to_ranks(conn_matrix)
         heatmap(conn_matrix)
         outpath = str(qa_dir / f"{Path(graphname).stem}.png")
@@ -310,5 +808,186 @@ class GraphTools:
         """
         User friendly wrapping and display of graph properties
         """
+        conn_matrix = self.adjacency()
+        n_nodes = conn_matrix.shape[0]
+        n_edges = triu(conn_matrix).nnz
         print("\nGraph Summary:")
-        print(nx.info(self.g))
+        print(f"Number of nodes: {n_nodes}")
+        print(f"Number of edges: {n_edges}")
+        if n_nodes > 0:
+            print(f"Average degree: {2 * n_edges / n_nodes:.4f}")
+
+    def adjacency(self):
+        """Adjacency matrix of the graph, as computed by `make_graphs` or converted from self.g
+
+        Returns
+        -------
+        csr_matrix
+            Symmetric (n_nodes, n_nodes) connectome matrix
+        """
+        if getattr(self, "conn_matrix", None) is None:
+            g = nx.convert_node_labels_to_integers(self.g, first_label=0)
+            self.conn_matrix = csr_matrix(nx.to_scipy_sparse_array(g))
+        return self.conn_matrix
+
+
+@timer
+def make_graphs(
+    graph_tools, error_margin=0, overlap_thr=1, voxel_size=2, chunk_size=100000
+):
+    """Takes streamlines and produces a graph for each of several parcellations, walking the streamlines only once.
+    The voxels visited by each streamline are computed a single time and shared by every parcellation.
+    Edge counts are kept as sparse matrices throughout, so memory scales with the number of edges rather than
+    with the square of the number of rois.
+
+    Parameters
+    ----------
+    graph_tools : list
+        GraphTools objects, one per parcellation, all sharing the same streamlines and label volume space
+        (e.g. the outputs of `reg_utils.skullstrip_check`). Streamlines and n_cpus are taken from the first one.
+        If the streamlines are given as a path to a .trk file, it is read in chunks of chunk_size. They can also
+        be the path to a .npz visit index from `write_visit_index`, which skips mapping the streamlines to voxels.
+    error_margin : int, optional
+        Number of mm around roi's to use (i.e. if 2, then any background voxel within 2 mm of an roi is considered part of
+        the nearest roi, so streamlines ending just outside an roi still count as reaching it). 0 uses the roi voxels only,
+        by default 0
+    overlap_thr : int, optional
+        The amount of overlap between an roi and streamline to be considered a connection, by default 1
+    voxel_size : int or sequence, optional
+        Voxel size in mm for roi/streamlines, isotropic or per axis, by default 2
+    chunk_size : int, optional
+        Maximum number of streamlines a worker processes at a time, by default 100000
+
+    Returns
+    -------
+    list
+        Symmetric CSR connectome matrices, in the order of graph_tools. Each is also stored as
+        the conn_matrix attribute of its GraphTools object.
+
+    Raises
+    ------
+    ValueError
+        Label volumes do not all have the same shape, or a different shape than the visit index
+    """
+    print("Building connectivity matrix...")
+
+    accumulator = ConnectomeAccumulator(
+        graph_tools, error_margin, overlap_thr, voxel_size
+    )
+    shape, node_vols = accumulator.shape, accumulator.node_vols
+
+    tracks = graph_tools[0].tracks
+    n_cpus = graph_tools[0].n_cpus
+    if str(tracks).endswith(".npz"):
+        chunks, index_shape = load_visit_index(tracks)
+        if index_shape != shape:
+            raise ValueError(
+                f"Visit index was built for shape {index_shape}, label volumes have shape {shape}"
+            )
+        nlines = sum(len(offsets) - 1 for offsets, _, _ in chunks)
+        tasks = (
+            delayed(_index_worker)(
+                offsets, vox, counts, start, stop, node_vols, overlap_thr
+            )
+            for offsets, vox, counts in chunks
+            for start, stop in _chunk_bounds(len(offsets) - 1, chunk_size, 1)
+        )
+    else:
+        nlines = _n_streamlines(tracks)
+        tasks = _streamline_tasks(
+            _connectome_worker,
+            tracks,
+            chunk_size,
+            n_cpus,
+            shape,
+            node_vols,
+            overlap_thr,
+        )
+    print("# of Streamlines: " + str(nlines))
+
+    # Fold each chunk's edge counts in as it completes rather than holding every partial result
+    for conns in Parallel(n_jobs=n_cpus, mmap_mode="r", return_as="generator")(tasks):
+        accumulator.add_counts(conns)
+
+    return accumulator.conn_matrices()
+
+
+class ConnectomeAccumulator:
+    """Keeps running edge counts for several parcellations, so streamlines can be added in batches
+    (e.g. straight from tractography) and discarded once they have been counted
+
+    Parameters
+    ----------
+    graph_tools : list
+        GraphTools objects, one per parcellation, all sharing the same label volume space
+    error_margin : int, optional
+        Number of mm around roi's to use (i.e. if 2, then any background voxel within 2 mm of an roi is considered part of
+        the nearest roi, so streamlines ending just outside an roi still count as reaching it). 0 uses the roi voxels only,
+        by default 0
+    overlap_thr : int, optional
+        The amount of overlap between an roi and streamline to be considered a connection, by default 1
+    voxel_size : int or sequence, optional
+        Voxel size in mm for roi/streamlines, isotropic or per axis, by default 2
+
+    Raises
+    ------
+    ValueError
+        Label volumes do not all have the same shape
+    """
+
+    def __init__(self, graph_tools, error_margin=0, overlap_thr=1, voxel_size=2):
+        shapes = {gt.rois.shape for gt in graph_tools}
+        if len(shapes) != 1:
+            raise ValueError(
+                f"Label volumes must all share one space, got shapes {shapes}"
+            )
+        (self.shape,) = shapes
+
+        self.graph_tools = graph_tools
+        self.overlap_thr = overlap_thr
+        self.node_vols = [
+            gt.node_volume(error_margin, voxel_size) for gt in graph_tools
+        ]
+        self.totals = [coo_matrix((mx, mx)).tocsr() for _, mx in self.node_vols]
+        self.n_streamlines = 0
+
+    def add(self, streamlines):
+        """Counts the edges of a batch of streamlines
+
+        Parameters
+        ----------
+        streamlines : ArraySequence or list
+            Streamlines in voxel coordinates of the label volumes
+        """
+        points, lengths = _flat_points(streamlines)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        conns = _connectome_worker(
+            points,
+            offsets,
+            0,
+            len(lengths),
+            self.shape,
+            self.node_vols,
+            self.overlap_thr,
+        )
+        self.add_counts(conns)
+        self.n_streamlines += len(lengths)
+
+    def add_counts(self, conns):
+        """Adds upper-triangular edge counts computed elsewhere, one matrix per parcellation"""
+        self.totals = list(map(add, self.totals, conns))
+
+    def conn_matrices(self):
+        """Symmetric connectome matrices of the edges counted so far
+
+        Returns
+        -------
+        list
+            Symmetric CSR connectome matrices, in the order of graph_tools. Each is also stored as
+            the conn_matrix attribute of its GraphTools object.
+        """
+        conn_matrices = []
+        for gt, conn_matrix in zip(self.graph_tools, self.totals):
+            gt.conn_matrix = conn_matrix + conn_matrix.T
+            conn_matrices.append(gt.conn_matrix)
+        return conn_matrices
@@ -16,7 +16,6 @@ import nibabel as nib
 import numpy as np
 from dipy.io.streamline import load_trk
 from dipy.tracking.streamline import deform_streamlines
-from nilearn.image import load_img, math_img
 
 from m2g.scripts import m2g_bids
 from m2g.stats.qa_fast import qa_fast_png
@@ -24,7 +23,26 @@ from m2g.stats.qa_reg import reg_mri_pngs
 from m2g.stats.qa_skullstrip import gen_overlay_pngs
 
 # m2g imports
-from m2g.utils import gen_utils, reg_utils
+from m2g.utils import gen_utils, morph_utils, reg_utils
+
+
+def _save_mask(mask, img, out, dtype=np.float32):
+    """Saves an array computed in memory on the voxel grid of img
+
+    Parameters
+    ----------
+    mask : ndarray
+        image data, e.g. a boolean mask
+    img : Nifti1Image
+        image whose affine and header are used
+    out : str
+        path for the output image
+    dtype : type, optional
+        on-disk data type, by default np.float32
+    """
+    out_img = nib.Nifti1Image(mask.astype(dtype), img.affine, img.header)
+    out_img.set_data_dtype(dtype)
+    nib.save(out_img, out)
 
 
 @gen_utils.timer
@@ -174,6 +192,7 @@ class DmriReg:
             f"{self.reg_m}" + f"/{self.t1w_name}_xfm_atlas2t1w_init.mat"
         )
         self.xfm_atlas2t1w = f"{self.reg_m}/{self.t1w_name}_xfm_atlas2t1w.mat"
+        self.xfm_mni2t1_aligned_mni = f"{self.reg_m}/xfm_mni2t1w_aligned_mni.mat"
         self.temp2dwi_xfm = f"{self.reg_m}/{self.dwi_name}_xfm_temp2dwi.mat"
 
         self.input_mni = f"{FSLDIR}/data/standard/MNI152_T1_{vox_size}_brain.nii.gz"
@@ -199,6 +218,8 @@ class DmriReg:
         self.vent_mask_dwi = f"{self.reg_a}/{self.t1w_name}_vent_mask_dwi.nii.gz"
         self.vent_csf_in_dwi = f"{self.reg_a}/{self.t1w_name}_vent_csf_in_dwi.nii.gz"
         self.vent_mask_mni = f"{self.reg_a}/vent_mask_mni.nii.gz"
+        self.vent_loc_mni_bin = f"{self.reg_a}/vent_loc_mni_bin.nii.gz"
+        self.corpuscallosum_mni_bin = f"{self.reg_a}/corpuscallosum_mni_bin.nii.gz"
         self.vent_mask_t1w = f"{self.reg_a}/vent_mask_t1w.nii.gz"
         self.wm_gm_int_in_dwi = (
             f"{self.reg_anat}/{self.t1w_name}_wm_gm_int_in_dwi.nii.gz"
@@ -266,15 +287,13 @@ class DmriReg:
         )
 
         # Threshold WM to binary in dwi space
-        self.t_img = load_img(self.wm_mask)
-        self.mask = math_img("img > 0.2", img=self.t_img)
-        self.mask.to_filename(self.wm_mask_thr)
+        wm_img = nib.load(self.wm_mask)
+        wm_thr = wm_img.get_fdata() > 0.2
+        _save_mask(wm_thr, wm_img, self.wm_mask_thr, dtype=np.int8)
 
         # Extract wm edge
-        # TODO : this should be a function in reg_utils so that we can print it to the log
-        cmd = f"fslmaths {self.wm_mask_thr} -edge -bin -mas {self.wm_mask_thr} {self.wm_edge}"
         print("Extracting white matter edge...")
-        gen_utils.run(cmd)
+        _save_mask(morph_utils.edge(wm_thr), wm_img, self.wm_edge)
 
     def check_gen_tissue_files(self):
         """Function for checking whether files were resliced or not.
@@ -437,7 +456,32 @@ class DmriReg:
             )
         reg_mri_pngs(self.t1w2dwi, self.nodif_B0, self.qa_reg)
 
-    def atlas2t1w2dwi_align(self, atlas, dsn=True):
+    @gen_utils.timer
+    def mni2t1_aligned_mni_align(self):
+        """Estimates the transform from template space onto t1_aligned_mni, by aligning the MNI template to it.
+        Parcellations share the template's MNI152NLin6 space, so it is estimated once per subject and passed to
+        atlas2t1w2dwi_align for each of them, instead of registering every parcellation.
+        Note: for this to work, must first have called t1w2dwi_align.
+
+        Returns
+        -------
+        str
+            path to the transform matrix, with the MNI template as input
+        """
+        reg_utils.align(
+            self.input_mni,
+            self.t1_aligned_mni,
+            init=None,
+            xfm=self.xfm_mni2t1_aligned_mni,
+            out=None,
+            dof=12,
+            searchrad=True,
+            interp="nearestneighbour",
+            cost="mutualinfo",
+        )
+        return self.xfm_mni2t1_aligned_mni
+
+    def atlas2t1w2dwi_align(self, atlas, mni2t1_xfm, dsn=True):
         """alignment from atlas to t1w to dwi. A function to perform atlas alignmet. Tries nonlinear registration first, and if that fails, does a liner
         registration instead.
         Note: for this to work, must first have called t1w2dwi_align.
@@ -445,6 +489,8 @@ class DmriReg:
         ----------
         atlas : str
             path to atlas file you want to use
+        mni2t1_xfm : str
+            path to the template to t1_aligned_mni transform from mni2t1_aligned_mni_align
         dsn : bool, optional
             is your space for tractography native-dsn, by default True
         Returns
@@ -453,28 +499,28 @@ class DmriReg:
             path to aligned atlas file
         """
 
-        self.atlas = atlas
-        self.atlas_name = gen_utils.get_filename(self.atlas)
-        self.aligned_atlas_t1mni = (
-            f"{self.reg_a}/{self.atlas_name}_aligned_atlas_t1w_mni.nii.gz"
-        )
-        self.aligned_atlas_skull = (
-            f"{self.reg_a}/{self.atlas_name}_aligned_atlas_skull.nii.gz"
-        )
-        self.dwi_aligned_atlas = (
-            f"{self.reg_anat}/{self.atlas_name}_aligned_atlas.nii.gz"
+        # Paths are local to the call, so several parcellations can be aligned at once
+        atlas_name = gen_utils.get_filename(atlas)
+        aligned_atlas_t1mni = f"{self.reg_a}/{atlas_name}_aligned_atlas_t1w_mni.nii.gz"
+        aligned_atlas_skull = f"{self.reg_a}/{atlas_name}_aligned_atlas_skull.nii.gz"
+        dwi_aligned_atlas = f"{self.reg_anat}/{atlas_name}_aligned_atlas.nii.gz"
+        xfm_atlas2t1w_init = f"{self.reg_m}/{atlas_name}_xfm_atlas2t1w_init.mat"
+        xfm_atlas2t1w = f"{self.reg_m}/{atlas_name}_xfm_atlas2t1w.mat"
+        temp2dwi_xfm = f"{self.reg_m}/{atlas_name}_xfm_temp2dwi.mat"
+
+        xfm_atlas2t1mni = f"{self.reg_m}/{atlas_name}_xfm_atlas2t1w_mni.mat"
+        reg_utils.transfer_xfm(
+            mni2t1_xfm,
+            self.input_mni,
+            atlas,
+            xfm_atlas2t1mni,
         )
-
-        reg_utils.align(
-            self.atlas,
+        reg_utils.resample_volumes(
             self.t1_aligned_mni,
-            init=None,
-            xfm=None,
-            out=self.aligned_atlas_t1mni,
-            dof=12,
-            searchrad=True,
+            atlas,
+            xfm_atlas2t1mni,
+            aligned_atlas_t1mni,
             interp="nearestneighbour",
-            cost="mutualinfo",
         )
 
         if (self.simple is False) and (dsn is False):
@@ -482,8 +528,8 @@ class DmriReg:
                 # Apply warp resulting from the inverse of T1w-->MNI created earlier
                 reg_utils.apply_warp(
                     self.t1w_brain,
-                    self.aligned_atlas_t1mni,
-                    self.aligned_atlas_skull,
+                    aligned_atlas_t1mni,
+                    aligned_atlas_skull,
                     warp=self.mni2t1w_warp,
                     interp="nn",
                     sup=True,
@@ -491,11 +537,11 @@ class DmriReg:
 
                 # Apply transform to dwi space
                 reg_utils.align(
-                    self.aligned_atlas_skull,
+                    aligned_atlas_skull,
                     self.nodif_B0,
                     init=self.t1wtissue2dwi_xfm,
                     xfm=None,
-                    out=self.dwi_aligned_atlas,
+                    out=dwi_aligned_atlas,
                     dof=6,
                     searchrad=True,
                     interp="nearestneighbour",
@@ -507,9 +553,9 @@ class DmriReg:
                 )
                 # Create transform to align atlas to T1w using flirt
                 reg_utils.align(
-                    self.atlas,
+                    atlas,
                     self.t1w_brain,
-                    xfm=self.xfm_atlas2t1w_init,
+                    xfm=xfm_atlas2t1w_init,
                     init=None,
                     bins=None,
                     dof=6,
@@ -520,33 +566,33 @@ class DmriReg:
                     sch=None,
                 )
                 reg_utils.align(
-                    self.atlas,
+                    atlas,
                     self.t1_aligned_mni,
-                    xfm=self.xfm_atlas2t1w,
+                    xfm=xfm_atlas2t1w,
                     out=None,
                     dof=6,
                     searchrad=True,
                     bins=None,
                     interp="spline",
                     cost="mutualinfo",
-                    init=self.xfm_atlas2t1w_init,
+                    init=xfm_atlas2t1w_init,
                 )
 
                 # Combine our linear transform from t1w to template with our transform from dwi to t1w space to get a transform from atlas ->(-> t1w ->)-> dwi
                 reg_utils.combine_xfms(
-                    self.xfm_atlas2t1w, self.t1wtissue2dwi_xfm, self.temp2dwi_xfm
+                    xfm_atlas2t1w, self.t1wtissue2dwi_xfm, temp2dwi_xfm
                 )
 
                 # Apply linear transformation from template to dwi space
-                reg_utils.applyxfm(
-                    self.nodif_B0, self.atlas, self.temp2dwi_xfm, self.dwi_aligned_atlas
+                reg_utils.resample_volumes(
+                    self.nodif_B0, atlas, temp2dwi_xfm, dwi_aligned_atlas
                 )
         elif dsn is False:
             # Create transform to align atlas to T1w using flirt
             reg_utils.align(
-                self.atlas,
+                atlas,
                 self.t1w_brain,
-                xfm=self.xfm_atlas2t1w_init,
+                xfm=xfm_atlas2t1w_init,
                 init=None,
                 bins=None,
                 dof=6,
@@ -557,71 +603,66 @@ class DmriReg:
                 sch=None,
             )
             reg_utils.align(
-                self.atlas,
+                atlas,
                 self.t1w_brain,
-                xfm=self.xfm_atlas2t1w,
+                xfm=xfm_atlas2t1w,
                 out=None,
                 dof=6,
                 searchrad=True,
                 bins=None,
                 interp="spline",
                 cost="mutualinfo",
-                init=self.xfm_atlas2t1w_init,
+                init=xfm_atlas2t1w_init,
             )
 
             # Combine our linear transform from t1w to template with our transform from dwi to t1w space to get a transform from atlas ->(-> t1w ->)-> dwi
-            reg_utils.combine_xfms(
-                self.xfm_atlas2t1w, self.t1wtissue2dwi_xfm, self.temp2dwi_xfm
-            )
+            reg_utils.combine_xfms(xfm_atlas2t1w, self.t1wtissue2dwi_xfm, temp2dwi_xfm)
 
             # Apply linear transformation from template to dwi space
-            reg_utils.applyxfm(
-                self.nodif_B0, self.atlas, self.temp2dwi_xfm, self.dwi_aligned_atlas
+            reg_utils.resample_volumes(
+                self.nodif_B0, atlas, temp2dwi_xfm, dwi_aligned_atlas
             )
         else:
             pass
 
         # Set intensities to int
         if dsn is False:
-            self.atlas_img = nib.load(self.dwi_aligned_atlas)
+            atlas_img = nib.load(dwi_aligned_atlas)
         else:
-            self.atlas_img = nib.load(self.aligned_atlas_t1mni)
-        self.atlas_data = np.around(self.atlas_img.get_data()).astype("int16")
-        node_num = len(np.unique(self.atlas_data))
-        self.atlas_data[self.atlas_data > node_num] = 0
-
-        t_img = load_img(self.wm_gm_int_in_dwi)
-        mask = math_img("img > 0", img=t_img)
-        mask.to_filename(self.wm_gm_int_in_dwi_bin)
+            atlas_img = nib.load(aligned_atlas_t1mni)
+        atlas_data = np.around(atlas_img.get_data()).astype("int16")
+        node_num = len(np.unique(atlas_data))
+        atlas_data[atlas_data > node_num] = 0
 
         if dsn is False:
             nib.save(
                 nib.Nifti1Image(
-                    self.atlas_data.astype(np.int32),
-                    affine=self.atlas_img.affine,
-                    header=self.atlas_img.header,
+                    atlas_data.astype(np.int32),
+                    affine=atlas_img.affine,
+                    header=atlas_img.header,
                 ),
-                self.dwi_aligned_atlas,
+                dwi_aligned_atlas,
             )
-            reg_mri_pngs(self.dwi_aligned_atlas, self.nodif_B0, self.qa_reg)
-            return self.dwi_aligned_atlas
+            reg_mri_pngs(dwi_aligned_atlas, self.nodif_B0, self.qa_reg)
+            return dwi_aligned_atlas
         else:
             nib.save(
                 nib.Nifti1Image(
-                    self.atlas_data.astype(np.int32),
-                    affine=self.atlas_img.affine,
-                    header=self.atlas_img.header,
+                    atlas_data.astype(np.int32),
+                    affine=atlas_img.affine,
+                    header=atlas_img.header,
                 ),
-                self.aligned_atlas_t1mni,
+                aligned_atlas_t1mni,
             )
-            reg_mri_pngs(self.aligned_atlas_t1mni, self.t1_aligned_mni, self.qa_reg)
-            return self.aligned_atlas_t1mni
+            reg_mri_pngs(aligned_atlas_t1mni, self.t1_aligned_mni, self.qa_reg)
+            return aligned_atlas_t1mni
 
     @gen_utils.timer
     def tissue2dwi_align(self):
         """alignment of ventricle and CC ROI's from MNI space --> dwi and CC and CSF from T1w space --> dwi
         A function to generate and perform dwi space alignment of avoidance/waypoint masks for tractography.
         First creates ventricle and CC ROI. Then creates transforms from stock MNI template to dwi space.
+        The tissue maps are thresholded and combined into masks in memory, and only the resulting masks are saved.
         NOTE: for this to work, must first have called both t1w2dwi_align and atlas2t1w2dwi_align.
         Raises
         ------
@@ -629,18 +670,17 @@ class DmriReg:
             Raised if FSL atlas for ventricle reference not found
         """
 
-        # Create MNI-space ventricle mask
+        # Create MNI-space ventricle and corpus callosum masks
         print("Creating MNI-space ventricle ROI...")
         if not os.path.isfile(self.mni_atlas):
             raise ValueError("FSL atlas for ventricle reference not found!")
-        cmd = f"fslmaths {self.mni_vent_loc} -thr 0.1 -bin {self.mni_vent_loc}"
-        gen_utils.run(cmd)
+        vent_img = nib.load(self.mni_vent_loc)
+        vent_mni = vent_img.get_fdata() >= 0.1
+        _save_mask(vent_mni, vent_img, self.vent_loc_mni_bin)
 
-        cmd = f"fslmaths {self.corpuscallosum} -bin {self.corpuscallosum}"
-        gen_utils.run(cmd)
-
-        cmd = f"fslmaths {self.corpuscallosum} -sub {self.mni_vent_loc} -bin {self.corpuscallosum}"
-        gen_utils.run(cmd)
+        cc_img = nib.load(self.corpuscallosum)
+        cc_mni = (cc_img.get_fdata() > 0) & ~vent_mni
+        _save_mask(cc_mni, cc_img, self.corpuscallosum_mni_bin)
 
         # Create a transform from the atlas onto T1w. This will be used to transform the ventricles to dwi space.
         reg_utils.align(
@@ -657,8 +697,11 @@ class DmriReg:
         )
 
         # Create transform to align roi to mni and T1w using flirt
-        reg_utils.applyxfm(
-            self.input_mni, self.mni_vent_loc, self.xfm_roi2mni_init, self.vent_mask_mni
+        reg_utils.resample_volumes(
+            self.input_mni,
+            self.vent_loc_mni_bin,
+            self.xfm_roi2mni_init,
+            self.vent_mask_mni,
         )
 
         if self.simple is False:
@@ -675,84 +718,69 @@ class DmriReg:
             # Apply warp resulting from the inverse MNI->T1w created earlier
             reg_utils.apply_warp(
                 self.t1w_brain,
-                self.corpuscallosum,
+                self.corpuscallosum_mni_bin,
                 self.corpuscallosum_mask_t1w,
                 warp=self.mni2t1w_warp,
                 interp="nn",
                 sup=True,
             )
 
-        # Applyxfm tissue maps to dwi space
-        reg_utils.applyxfm(
-            self.nodif_B0,
+        # Apply the t1w to dwi transform to every tissue map in one pass, keeping them in memory
+        tissues_t1w = [
             self.vent_mask_t1w,
-            self.t1wtissue2dwi_xfm,
-            self.vent_mask_dwi,
-        )
-        reg_mri_pngs(self.vent_mask_dwi, self.nodif_B0, self.qa_reg)
-        reg_utils.applyxfm(
-            self.nodif_B0,
             self.corpuscallosum_mask_t1w,
+            self.csf_mask,
+            self.gm_mask,
+            self.wm_mask,
+        ]
+        aligned = reg_utils.resample_volumes(
+            self.nodif_B0,
+            tissues_t1w,
             self.t1wtissue2dwi_xfm,
-            self.corpuscallosum_dwi,
+            [None, None, None, self.gm_in_dwi, self.wm_in_dwi],
         )
-        reg_mri_pngs(self.corpuscallosum_dwi, self.nodif_B0, self.qa_reg)
-        reg_utils.applyxfm(
-            self.nodif_B0, self.csf_mask, self.t1wtissue2dwi_xfm, self.csf_mask_dwi
-        )
-        reg_mri_pngs(self.csf_mask_dwi, self.nodif_B0, self.qa_reg)
-        reg_utils.applyxfm(
-            self.nodif_B0, self.gm_mask, self.t1wtissue2dwi_xfm, self.gm_in_dwi
-        )
-        reg_mri_pngs(self.gm_in_dwi, self.nodif_B0, self.qa_reg)
-        reg_utils.applyxfm(
-            self.nodif_B0, self.wm_mask, self.t1wtissue2dwi_xfm, self.wm_in_dwi
-        )
-        reg_mri_pngs(self.wm_in_dwi, self.nodif_B0, self.qa_reg)
-
-        # Threshold WM to binary in dwi space
-        thr_img = nib.load(self.wm_in_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.15] = 0
-        nib.save(thr_img, self.wm_in_dwi_bin)
-
-        # Threshold GM to binary in dwi space
-        thr_img = nib.load(self.gm_in_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.15] = 0
-        nib.save(thr_img, self.gm_in_dwi_bin)
-
-        # Threshold CSF to binary in dwi space
-        thr_img = nib.load(self.csf_mask_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.99] = 0
-        nib.save(thr_img, self.csf_mask_dwi)
-
-        # Threshold WM to binary in dwi space
-        self.t_img = load_img(self.wm_in_dwi_bin)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.wm_in_dwi_bin)
+        ref_img = aligned[0]
+        vent, cc, csf, gm, wm = [np.asanyarray(img.dataobj) for img in aligned]
 
-        # Threshold GM to binary in dwi space
-        self.t_img = load_img(self.gm_in_dwi_bin)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.gm_in_dwi_bin)
-
-        # Threshold CSF to binary in dwi space
-        self.t_img = load_img(self.csf_mask_dwi)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.csf_mask_dwi_bin)
+        # Threshold WM, GM and CSF to binary in dwi space
+        wm_bin = wm >= 0.15
+        gm_bin = gm >= 0.15
+        csf[csf < 0.99] = 0
+        csf_bin = csf > 0
+        _save_mask(csf, ref_img, self.csf_mask_dwi)
 
         # Create ventricular CSF mask
         print("Creating ventricular CSF mask...")
-        cmd = f"fslmaths {self.vent_mask_dwi} -kernel sphere 10 -ero -bin {self.vent_mask_dwi}"
-        gen_utils.run(cmd)
+        vent = morph_utils.erode_sphere(vent, 10, ref_img.header.get_zooms())
         print("Creating Corpus Callosum mask...")
-        cmd = f"fslmaths {self.corpuscallosum_dwi} -mas {self.wm_in_dwi_bin} -bin {self.corpuscallosum_dwi}"
-        gen_utils.run(cmd)
-        cmd = f"fslmaths {self.csf_mask_dwi} -add {self.vent_mask_dwi} -bin {self.vent_csf_in_dwi}"
-        gen_utils.run(cmd)
+        cc = (cc > 0) & wm_bin
+        vent_csf = csf_bin | vent
 
         # Create gm-wm interface image
-        cmd = (
-            f"fslmaths {self.gm_in_dwi_bin} -mul {self.wm_in_dwi_bin} -add {self.corpuscallosum_dwi} "
-            f"-sub {self.vent_csf_in_dwi} -mas {self.nodif_B0_mask} -bin {self.wm_gm_int_in_dwi}"
-        )
-        gen_utils.run(cmd)
+        wm_gm_int = (gm_bin & wm_bin).astype(np.int8) + cc - vent_csf
+        wm_gm_int = (wm_gm_int > 0) & (nib.load(self.nodif_B0_mask).get_fdata() > 0)
+
+        for mask, out in [
+            (vent, self.vent_mask_dwi),
+            (cc, self.corpuscallosum_dwi),
+            (vent_csf, self.vent_csf_in_dwi),
+            (wm_gm_int, self.wm_gm_int_in_dwi),
+        ]:
+            _save_mask(mask, ref_img, out)
+        for mask, out in [
+            (wm_bin, self.wm_in_dwi_bin),
+            (gm_bin, self.gm_in_dwi_bin),
+            (csf_bin, self.csf_mask_dwi_bin),
+            (wm_gm_int, self.wm_gm_int_in_dwi_bin),
+        ]:
+            _save_mask(mask, ref_img, out, dtype=np.int8)
+
+        tissues_dwi = [
+            self.vent_mask_dwi,
+            self.corpuscallosum_dwi,
+            self.csf_mask_dwi,
+            self.gm_in_dwi,
+            self.wm_in_dwi,
+        ]
+        for tissue_dwi in tissues_dwi:
+            reg_mri_pngs(tissue_dwi, self.nodif_B0, self.qa_reg)
@@ -242,6 +242,30 @@ def main():
         help="Seeding density for tractography in the m2g-d pipeline. Default is 20.",
         default=20,
     )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        default=False,
+        help="Whether to count connectome edges while tracking instead of from the saved tractogram. Only supported in native space.",
+    )
+    parser.add_argument(
+        "--skiptrk",
+        action="store_true",
+        default=False,
+        help="Whether to skip saving streamlines.trk when running with --fused.",
+    )
+    parser.add_argument(
+        "--error_margin",
+        action="store",
+        help="Distance in mm around each roi within which streamline points that fall in the background are counted as part of the nearest roi. Default is 0 (roi voxels only).",
+        default=0,
+    )
+    parser.add_argument(
+        "--random_seed",
+        action="store",
+        help="Seed for the random number generators of tractography, so reruns give the same streamlines. Default is 42.",
+        default=42,
+    )
     parser.add_argument(
         "--skull",
         action="store",
@@ -295,6 +319,10 @@ def main():
         "skipreg": result.skipreg,
         "skull": result.skull,
         "n_cpus": result.n_cpus,
+        "fused": result.fused,
+        "skiptrk": result.skiptrk,
+        "error_margin": result.error_margin,
+        "random_seed": result.random_seed,
     }
 
     # ---------------- S3 stuff ---------------- #
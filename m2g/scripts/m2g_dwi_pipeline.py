@@ -54,6 +54,10 @@ def m2g_dwi_worker(
     skipreg=False,
     skull=None,
     n_cpus=1,
+    fused=False,
+    skiptrk=False,
+    error_margin=0,
+    random_seed=42,
 ):
     """Creates a brain graph from MRI data
     Parameters
@@ -94,12 +98,25 @@ def m2g_dwi_worker(
         skullstrip parameter pre-set. Default is "none".
     n_cpus : int, optional
         Number of CPUs to use for computing edges from streamlines
+    fused : bool, optional
+        Whether to count connectome edges for every parcellation while tracking, discarding each batch of
+        streamlines once counted. Only supported in native space. Default is False.
+    skiptrk : bool, optional
+        Whether to skip writing streamlines.trk (and tractography QA) in fused mode. Default is False.
+    error_margin : float, optional
+        Distance in mm around each roi within which background voxels are counted as part of the nearest roi
+        when estimating connectomes. Default is 0, which uses the roi voxels only.
+    random_seed : int, optional
+        Seed for the seed placement and the random number generators of tractography, so reruns (with any
+        n_cpus) give the same streamlines. Default is 42.
     Raises
     ------
     ValueError
         Raised if downsampling voxel size is not supported
     ValueError
         Raised if bval/bvecs are potentially corrupted
+    ValueError
+        Raised if fused is used outside of native space, or skiptrk without fused
     """
 
     # -------- Initial Setup ------------------ #
@@ -111,6 +128,10 @@ def m2g_dwi_worker(
     # initial assertions
     if vox_size not in ["1mm", "2mm", "4mm"]:
         raise ValueError("Voxel size not supported. Use 4mm, 2mm, or 1mm")
+    if fused and reg_style != "native":
+        raise ValueError("Fused connectome estimation needs native space tractography")
+    if skiptrk and not fused:
+        raise ValueError("streamlines.trk can only be skipped with fused")
 
     print("Checking inputs...")
     for file_ in [t1w, bvals, bvecs, dwi, atlas, mask, *parcellations]:
@@ -266,7 +287,7 @@ def m2g_dwi_worker(
         reg.tissue2dwi_align()
 
     # Align atlas to dwi-space and check that the atlas hasn't lost any of the rois
-    _ = [reg, parcellations, outdir, prep_anat, vox_size, reg_style]
+    _ = [reg, parcellations, outdir, prep_anat, vox_size, reg_style, int(n_cpus)]
     labels_im_file_list = reg_utils.skullstrip_check(*_)
 
     # -------- Tensor Fitting and Fiber Tractography ---------------- #
@@ -278,7 +299,12 @@ def m2g_dwi_worker(
     qa_tensor = str(init_dirs["qa_dirs"][6] / "/Tractography_Model_Peak_Directions.png")
 
     # build seeds
-    seeds = track.build_seed_list(reg.wm_gm_int_in_dwi, np.eye(4), dens=int(seeds))
+    seeds = track.build_seed_list(
+        reg.wm_gm_int_in_dwi,
+        np.eye(4),
+        dens=int(seeds),
+        random_seed=int(random_seed),
+    )
     print("Using " + str(len(seeds)) + " seeds...")
 
     # Compute direction model and track fiber streamlines
@@ -298,22 +324,38 @@ def m2g_dwi_worker(
         qa_tensor,
         seeds,
         np.eye(4),
+        n_cpus=n_cpus,
+        random_seed=int(random_seed),
+        cache_dir=init_dirs["dwi_dirs"][2],
     )
-    streamlines = trct.run()
-    trk_hdr = trct.make_hdr(streamlines, hdr)
-    tractogram = nib.streamlines.Tractogram(
-        streamlines, affine_to_rasmm=trk_hdr["voxel_to_rasmm"]
-    )
-    trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
-    streams = os.path.join(prep_track, "streamlines.trk")
-    nib.streamlines.save(trkfile, streams)
+    streams = None if skiptrk else os.path.join(prep_track, "streamlines.trk")
+    voxel_size = int(vox_size[0])  # label volumes are resampled to vox_size
+    if fused:
+        # Every batch of streamlines is counted into each parcellation's connectome, then dropped
+        graph_tools = build_graph_tools(
+            parcellations, labels_im_file_list, outdir, init_dirs, n_cpus
+        )
+        print(
+            f"Generating graphs for {len(parcellations)} parcellations while tracking..."
+        )
+        accumulator = graph.ConnectomeAccumulator(
+            graph_tools, error_margin=float(error_margin), voxel_size=voxel_size
+        )
+        trct.track_connectomes(accumulator, streams, hdr)
+        accumulator.conn_matrices()
+    else:
+        # Streamlines are written to disk batch by batch as they are tracked
+        trct.save_tracks(streams, hdr)
+    del trct
 
     print("Streamlines complete")
     print(f"Tractography runtime: {np.round(time.time() - start_time, 1)}")
 
     # TODO: Get rid of native_dsn once and for all?
     if reg_style == "native_dsn":
-        fa_path = track.tens_mod_fa_est(gtab, eddy_corrected_data, nodif_B0_mask)
+        fa_path = track.tens_mod_fa_est(
+            gtab, eddy_corrected_data, nodif_B0_mask, n_cpus=int(n_cpus)
+        )
         # Normalize streamlines
         print("Running DSN...")
         streamlines_mni, streams_mni = register.direct_streamline_norm(
@@ -323,31 +365,36 @@ def m2g_dwi_worker(
         print("Saving DSN-registered streamlines: " + streams_mni)
 
     # ------- Connectome Estimation --------------------------------- #
-    # Generate graphs from streamlines for each parcellation
-    global tracks
-    if reg_style == "native":
-        tracks = streamlines
-    elif reg_style == "native_dsn":
-        tracks = streamlines_mni
-
-    for idx, parc in enumerate(parcellations):
-        print(f"Generating graph for {parc} parcellation...")
-        print(f"Applying native-space alignment to {parcellations[idx]}")
+    if not fused:
+        # Generate graphs for each parcellation from the saved streamlines, which are read back in chunks
+        # so the full tractogram does not have to stay in memory
+        global tracks
         if reg_style == "native":
-            tracks = streamlines
+            tracks = streams
         elif reg_style == "native_dsn":
-            tracks = streamlines_mni
-        # rois = nib.load(labels_im_file_list[idx]).get_fdata().astype(int)
-        g1 = graph.GraphTools(
-            attr=parcellations[idx],
-            rois=labels_im_file_list[idx],  # rois,
-            tracks=tracks,
-            affine=np.eye(4),
-            outdir=outdir,
-            connectome_path=init_dirs["connectomes"][idx],
+            tracks = streams_mni
+            del streamlines_mni
+
+        # Record the voxels each streamline visits next to the tractogram, so connectomes for other
+        # parcellations or thresholds can be recomputed from it without another tractogram pass
+        tracks = graph.write_visit_index(
+            tracks,
+            nib.load(labels_im_file_list[0]).shape,
+            os.path.splitext(tracks)[0] + "_visits.npz",
             n_cpus=n_cpus,
         )
-        g1.g = g1.make_graph()
+
+        # Every parcellation shares a single pass over the streamlines. The label volumes are only
+        # loaded now, so they are not held (and inherited by tracking workers) during tractography
+        print(f"Generating graphs for {len(parcellations)} parcellations...")
+        graph_tools = build_graph_tools(
+            parcellations, labels_im_file_list, outdir, init_dirs, n_cpus, tracks
+        )
+        graph.make_graphs(
+            graph_tools, error_margin=float(error_margin), voxel_size=voxel_size
+        )
+
+    for idx, g1 in enumerate(graph_tools):
         g1.summary()
         g1.save_graph_png(init_dirs["qa_dirs"][3], init_dirs["connectomes"][idx])
         g1.save_graph(init_dirs["connectomes"][idx])
@@ -356,6 +403,8 @@ def m2g_dwi_worker(
 
     if "M2G_URL" in os.environ:
         print("Note: tractography QA does not work in a Docker environment.")
+    elif streams is None:
+        print("Note: tractography QA skipped, streamlines.trk was not written.")
     else:
         # TODO: Check that this still works
         qa_tractography_out = outdir / "qa/fibers"
@@ -372,6 +421,47 @@ def m2g_dwi_worker(
     )
 
 
+def build_graph_tools(
+    parcellations, labels_im_file_list, outdir, init_dirs, n_cpus, tracks=None
+):
+    """Creates the GraphTools object of each parcellation, loading its label volume
+
+    Parameters
+    ----------
+    parcellations : list
+        Filepaths to the parcellations we're using
+    labels_im_file_list : list
+        Filepaths to the parcellations aligned to dwi space, in the same order
+    outdir : Path
+        The directory where the output files are stored
+    init_dirs : dict
+        Output directory tree from `gen_utils.make_initial_directories`
+    n_cpus : int
+        Number of CPUs to use for computing edges from streamlines
+    tracks : str, optional
+        Path to the streamlines (or their visit index), by default None
+
+    Returns
+    -------
+    list
+        GraphTools object of each parcellation
+    """
+    graph_tools = []
+    for idx, parc in enumerate(parcellations):
+        print(f"Applying native-space alignment to {parc}")
+        g1 = graph.GraphTools(
+            attr=parc,
+            rois=labels_im_file_list[idx],
+            tracks=tracks,
+            affine=np.eye(4),
+            outdir=outdir,
+            connectome_path=init_dirs["connectomes"][idx],
+            n_cpus=n_cpus,
+        )
+        graph_tools.append(g1)
+    return graph_tools
+
+
 def welcome_message(connectomes):
 
     line = """\n~~~~~~~~~~~~~~~~\n 
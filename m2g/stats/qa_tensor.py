@@ -12,7 +12,6 @@ for models used during the tractrography step.
 import warnings
 
 warnings.simplefilter("ignore")
-import itertools
 from argparse import ArgumentParser
 
 import matplotlib
@@ -28,9 +27,9 @@ matplotlib.use("Agg")  # very important above pyplot import
 import matplotlib.pyplot as plt
 
 
-def generate_3_d_directions(peak_dirs, peak_values):
+def generate_3_d_directions(peak_dirs, peak_values, max_glyphs=None):
     """
-    Generates 3-d data required for plotting directions for the entire brain volume
+    Generates 3-d data required for plotting directions for the voxels of the brain volume with a peak
 
     Parameters
     -----------
@@ -38,11 +37,13 @@ def generate_3_d_directions(peak_dirs, peak_values):
         peak_dirs from tractography model (x,y,z directional vectors)
     peak_values: np array
         peak_values from tractography model (magnitude)
+    max_glyphs: int
+        maximum number of voxels to return, evenly subsampled. all of them if None
 
     Returns
     -----------
     centers: np array
-        cartesian coordinates
+        voxel coordinates
     directions: np array
         vector directions (x,y,z) in flattened format
     directions_colors: np array
@@ -50,35 +51,27 @@ def generate_3_d_directions(peak_dirs, peak_values):
     heights: np array
         vector magnitudes in flattened format
     """
-
-    # initialize
-    centers = []
-    directions = []
-    heights = []
-    directions_colors = []
-
-    xs = range(peak_dirs.shape[0])
-    ys = range(peak_dirs.shape[1])
-    zs = range(peak_dirs.shape[2])
-    for x, y, z in itertools.product(xs, ys, zs):
-        centers.append([x, y, z])
-
-        # relies on the fact that peaks_from_models generates peak_dirs and peak_values in descending order
-        directions.append(peak_dirs[x, y, z, 0, :])
-        heights.append(peak_values[x, y, z, 0])
-
-    # convert to np arrays
-    centers = np.asarray(centers)
-    directions = np.asarray(directions)
-    heights = np.asarray(heights)
+    # relies on the fact that peaks_from_models generates peak_dirs and peak_values in descending order
+    found = peak_values[..., 0] > 0
+    centers = np.argwhere(found)
+    if max_glyphs is not None and len(centers) > max_glyphs:
+        centers = centers[np.linspace(0, len(centers) - 1, max_glyphs).astype(int)]
+    voxels = tuple(centers.T)
+    directions = peak_dirs[..., 0, :][voxels]
+    heights = peak_values[..., 0][voxels]
 
     # get rgb based on directional components
-    directions_colors = orient2rgb(directions)
+    if len(directions) > 0:
+        directions_colors = orient2rgb(directions)
+    else:
+        directions_colors = np.zeros((0, 3))
 
     return centers, directions, directions_colors, heights
 
 
-def plot_directions(peak_dirs, peak_values, x_angle, y_angle, size=(300, 300)):
+def plot_directions(
+    peak_dirs, peak_values, x_angle, y_angle, size=(300, 300), max_glyphs=None
+):
     """
     Opens a 3-d fury window of the maximum peaks visualized
 
@@ -97,9 +90,11 @@ def plot_directions(peak_dirs, peak_values, x_angle, y_angle, size=(300, 300)):
         angle to rotate image along y axis
     size: tuple
         size of fury window
+    max_glyphs: int
+        maximum number of arrows to draw, evenly subsampled. all of them if None
     """
     centers, directions, directions_colors, heights = generate_3_d_directions(
-        peak_dirs, peak_values
+        peak_dirs, peak_values, max_glyphs
     )
 
     scene = window.Scene()
@@ -112,6 +107,25 @@ def plot_directions(peak_dirs, peak_values, x_angle, y_angle, size=(300, 300)):
     window.show(scene, size=size)
 
 
+def slice_positions(im_shape, slices=(0.35, 0.51, 0.65)):
+    """
+    Positions of the sagittal, coronal and axial slices shown in the qa figure
+
+    Parameters
+    -----------
+    im_shape: tuple
+        shape of the 3-d volume
+    slices: tuple
+        fractions of each axis to take slices at
+
+    Returns
+    -----------
+    coords: tuple
+        list of slice positions along each of the x, y and z axes
+    """
+    return tuple([int(n * frac) for frac in slices] for n in im_shape[:3])
+
+
 def create_qa_figure(peak_dirs, peak_values, output_dir, model):
     """
     Creates a 9x9 figure of the 3-d volume and saves it
@@ -141,28 +155,11 @@ def create_qa_figure(peak_dirs, peak_values, output_dir, model):
         peak_dirs, peak_values
     )
 
-    # reshape back into a 3-d volume with voxel encoded RGB values corresponding to directional vectors
-    im = directions_colors.reshape(im_shape_rgb)
-
-    slices = (0.35, 0.51, 0.65)
-
-    x = [
-        int(im_shape[0] * slices[0]),
-        int(im_shape[0] * slices[1]),
-        int(im_shape[0] * slices[2]),
-    ]
-    y = [
-        int(im_shape[1] * slices[0]),
-        int(im_shape[1] * slices[1]),
-        int(im_shape[1] * slices[2]),
-    ]
-    z = [
-        int(im_shape[2] * slices[0]),
-        int(im_shape[2] * slices[1]),
-        int(im_shape[2] * slices[2]),
-    ]
-
-    coords = (x, y, z)
+    # place back into a 3-d volume with voxel encoded RGB values corresponding to directional vectors
+    im = np.zeros(im_shape_rgb)
+    im[tuple(centers.T)] = directions_colors
+
+    coords = slice_positions(im_shape)
     labs = ["Sagittal Slice", "Coronal Slice", "Axial Slice"]
     var = ["X", "Y", "Z"]
 
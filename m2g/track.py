@@ -9,17 +9,33 @@ Theory described here: https://neurodata.io/talks/ndmg.pdf#page=21
 """
 
 # system imports
+import hashlib
+import multiprocessing
 import os
+import random
+from collections import OrderedDict
+from functools import lru_cache, partial
+from itertools import islice
 
+import dipy
 import nibabel as nib
 
 # external package imports
 import numpy as np
 from dipy.data import get_sphere
-from dipy.direction import ProbabilisticDirectionGetter, peaks_from_model
+from dipy.direction import (
+    PeaksAndMetrics,
+    ProbabilisticDirectionGetter,
+    peaks_from_model,
+)
 from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel, recursive_response
-from dipy.reconst.dti import TensorModel, fractional_anisotropy, quantize_evecs
-from dipy.reconst.shm import CsaOdfModel
+from dipy.reconst.dti import (
+    TensorFit,
+    TensorModel,
+    fractional_anisotropy,
+    quantize_evecs,
+)
+from dipy.reconst.shm import CsaOdfModel, sh_to_sf_matrix
 from dipy.tracking import utils
 from dipy.tracking.local_tracking import LocalTracking, ParticleFilteringTracking
 from dipy.tracking.stopping_criterion import (
@@ -34,8 +50,611 @@ from dipy.tracking.streamline import Streamlines
 from m2g.stats import qa_tensor
 from m2g.utils.gen_utils import timer
 
+# Settings for peaks_from_model, part of the model peaks cache key
+PEAKS_PARAMS = dict(
+    relative_peak_threshold=0.5,
+    min_separation_angle=25,
+    npeaks=5,
+    normalize_peaks=True,
+    sh_order=6,
+)
+PEAKS_FIELDS = [
+    "peak_dirs",
+    "peak_values",
+    "peak_indices",
+    "gfa",
+    "qa",
+    "shm_coeff",
+    "B",
+]
+# Volumes of the model fit cache that can be stored as float32, to keep cached fits small
+CACHE_FLOAT32 = ["peak_dirs", "peak_values", "gfa", "qa", "shm_coeff"]
+
+# Diffusion models by acquisition protocol and parameters, reused across the subjects of a process,
+# see `diffusion_model`. CSD models depend on each subject's response function and are built directly
+MODELS = dict(tensor=TensorModel, csa=CsaOdfModel)
+MODEL_CACHE_SIZE = 8
+_MODELS = OrderedDict()
+
+
+def protocol_key(gtab, bval_decimals=1, bvec_decimals=6):
+    """Hash of an acquisition protocol: bvals and bvecs rounded to ignore text file precision, and b0 threshold
+
+    Parameters
+    ----------
+    gtab : GradientTable
+        gradient table created from bval and bvec files
+    bval_decimals : int, optional
+        Decimals bvals are rounded to, by default 1
+    bvec_decimals : int, optional
+        Decimals bvecs are rounded to, by default 6
+
+    Returns
+    -------
+    str
+        Hex digest identifying the protocol
+    """
+    key = hashlib.sha1()
+    for arr, decimals in [(gtab.bvals, bval_decimals), (gtab.bvecs, bvec_decimals)]:
+        # + 0.0 turns the -0.0 of rounding into 0.0
+        arr = np.ascontiguousarray(np.round(arr, decimals) + 0.0, dtype=np.float64)
+        key.update(f"{arr.shape}".encode())
+        key.update(arr.data)
+    key.update(f"{gtab.b0_threshold}".encode())
+    return key.hexdigest()
+
+
+def diffusion_model(kind, gtab, **params):
+    """Builds a diffusion model, or returns the one built earlier in this process for the same acquisition
+    protocol and parameters, so subjects sharing a gradient scheme skip recomputing its basis matrices.
+    The MODEL_CACHE_SIZE most recently used models are kept.
+
+    Parameters
+    ----------
+    kind : str
+        Model from MODELS: tensor or csa
+    gtab : GradientTable
+        gradient table created from bval and bvec files
+    params : dict
+        Parameters of the model, which must be hashable
+
+    Returns
+    -------
+    ReconstModel
+        The diffusion model
+    """
+    key = (kind, protocol_key(gtab), tuple(sorted(params.items())))
+    if key in _MODELS:
+        print(f"Reusing {kind} model of an earlier subject with the same protocol...")
+        _MODELS.move_to_end(key)
+        return _MODELS[key]
+    model = MODELS[kind](gtab, **params)
+    _MODELS[key] = model
+    if len(_MODELS) > MODEL_CACHE_SIZE:
+        _MODELS.popitem(last=False)
+    return model
+
+
+@lru_cache(maxsize=None)
+def load_sphere(name):
+    """dipy's get_sphere, loaded from disk once per process
+
+    Parameters
+    ----------
+    name : str
+        Name of the sphere, e.g. "repulsion724"
+
+    Returns
+    -------
+    Sphere
+        The sphere, shared by every caller, so it must not be modified
+    """
+    return get_sphere(name)
+
+
+@lru_cache(maxsize=8)
+def _sh_to_sf(sphere, sh_order):
+    """sh_to_sf_matrix of a sphere from `load_sphere`, computed once per process"""
+    return sh_to_sf_matrix(sphere, sh_order, return_inv=False)
+
+
+# Streamline generator factory shared with forked tracking workers, see `RunTrack.track`
+_TRACKER = None
+
+
+def _track_shard(shard):
+    """Tracks one shard of seeds with the streamline generator factory inherited from the parent process
+
+    Parameters
+    ----------
+    shard : tuple
+        Random seed of the shard and seed points of the shard
+
+    Returns
+    -------
+    ArraySequence
+        Streamlines of the shard, in seed order
+    """
+    # forked workers start with identical RNG states, so each shard draws from its own seed;
+    # with a random_seed set, dipy also reseeds from each seed point, so results do not depend on sharding
+    shard_seed, seeds = shard
+    random.seed(int(shard_seed))
+    np.random.seed(shard_seed)
+    return _keep_long(Streamlines(_TRACKER(seeds=seeds)))
+
+
+def _keep_long(streamlines, min_points=60):
+    """Drops streamlines that are too short to be kept in the tractogram
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines to filter
+    min_points : int, optional
+        Streamlines need more points than this to be kept, by default 60
+
+    Returns
+    -------
+    ArraySequence
+        Compact copy of the streamlines that are long enough
+    """
+    return streamlines[streamlines._lengths > min_points].copy()
+
+
+def _save_peaks(pam, cache_file, float32=False):
+    """Saves the arrays of a PeaksAndMetrics object to an .npz file, replacing it atomically
+
+    Parameters
+    ----------
+    pam : PeaksAndMetrics
+        Output of peaks_from_model with return_sh=True
+    cache_file : str
+        Path of the .npz file
+    float32 : bool, optional
+        Whether to store the volumes in CACHE_FLOAT32 as float32, by default False
+
+    Returns
+    -------
+    PeaksAndMetrics
+        The peaks as they are loaded back from the cache, at its precision
+    """
+    arrays = _save_npz(
+        cache_file,
+        float32=float32,
+        **{field: getattr(pam, field) for field in PEAKS_FIELDS},
+    )
+    return _peaks_and_metrics(pam.sphere, arrays)
+
+
+def _save_npz(cache_file, float32=False, **arrays):
+    """Saves arrays to a compressed .npz file, replacing it atomically so concurrent runs never read a partial file
+
+    Parameters
+    ----------
+    cache_file : str
+        Path of the .npz file
+    float32 : bool, optional
+        Whether to store the volumes in CACHE_FLOAT32 as float32, by default False
+    arrays : ndarray
+        Arrays to save, by name
+
+    Returns
+    -------
+    dict
+        The arrays as `_load_npz` reads them back, so a fresh fit tracks exactly like a cached one
+    """
+    if float32:
+        arrays = {
+            name: arr.astype(np.float32) if name in CACHE_FLOAT32 else arr
+            for name, arr in arrays.items()
+        }
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_file, cache_file)
+    return _from_cache(arrays)
+
+
+def _load_npz(cache_file, names):
+    """Loads arrays saved by `_save_npz`, with any float32 volumes cast back to float64
+
+    Parameters
+    ----------
+    cache_file : str
+        Path of the .npz file
+    names : list
+        Names of the arrays to load
+
+    Returns
+    -------
+    dict
+        Array for each name
+    """
+    with np.load(cache_file) as cache:
+        return _from_cache({name: cache[name] for name in names})
+
+
+def _from_cache(arrays):
+    """Casts the float32 volumes of cached arrays back to float64, the precision the models are tracked with"""
+    return {
+        name: arr.astype(np.float64, copy=False) if name in CACHE_FLOAT32 else arr
+        for name, arr in arrays.items()
+    }
+
+
+def _load_peaks(cache_file, sphere):
+    """Loads a PeaksAndMetrics object saved by `_save_peaks`
+
+    Parameters
+    ----------
+    cache_file : str
+        Path of the .npz file
+    sphere : Sphere
+        Sphere the peaks were found on
+
+    Returns
+    -------
+    PeaksAndMetrics
+        Peaks usable as a direction getter, with ODF spherical harmonic coefficients
+    """
+    return _peaks_and_metrics(sphere, _load_npz(cache_file, PEAKS_FIELDS))
+
+
+def _peaks_and_metrics(sphere, arrays):
+    """Assembles a PeaksAndMetrics object from its arrays
+
+    Parameters
+    ----------
+    sphere : Sphere
+        Sphere the peaks were found on
+    arrays : dict
+        Array for each of PEAKS_FIELDS
+
+    Returns
+    -------
+    PeaksAndMetrics
+        Peaks usable as a direction getter, with ODF spherical harmonic coefficients
+    """
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    for field in PEAKS_FIELDS:
+        setattr(pam, field, arrays[field])
+    pam.odf = None
+    return pam
+
+
+def bounding_box(*masks, pad=1):
+    """Finds the smallest box of voxels holding every nonzero voxel of the masks
+
+    Parameters
+    ----------
+    masks : ndarray
+        3D volumes of the same shape
+    pad : int, optional
+        Number of voxels to grow the box by on each side, so interpolation at its border sees the same
+        neighbours as in the whole volume, by default 1
+
+    Returns
+    -------
+    tuple
+        One slice per axis, the whole volume if every mask is empty
+    """
+    shape = masks[0].shape
+    nonzero = np.zeros(shape, dtype=bool)
+    for mask in masks:
+        nonzero |= np.asanyarray(mask) > 0
+    bbox = []
+    for axis in range(nonzero.ndim):
+        other = tuple(ax for ax in range(nonzero.ndim) if ax != axis)
+        (occupied,) = np.nonzero(nonzero.any(axis=other))
+        if len(occupied) == 0:
+            return tuple(slice(0, n) for n in shape)
+        bbox.append(
+            slice(max(occupied[0] - pad, 0), min(occupied[-1] + 1 + pad, shape[axis]))
+        )
+    return tuple(bbox)
+
+
+class MaskedDWI:
+    """The in-mask voxels of a dwi image, as a compact (n_vox, n_dirs) float32 array
+
+    The image is read one volume at a time, so neither the background voxels nor a float64 copy of the
+    4D data are ever held in memory.
+
+    Parameters
+    ----------
+    dwi_file : str
+        Path to the 4D dwi image
+    mask : ndarray
+        3D boolean mask of the voxels to keep
+    memmap_file : str, optional
+        Path of a .npy file to hold the voxels on disk instead of in memory, by default None
+    bbox : tuple, optional
+        Slices of the dwi volume to read, e.g. from `bounding_box`, with mask shaped like the cropped
+        volume, by default None (the whole volume)
+
+    Attributes
+    ----------
+    data : ndarray
+        (n_vox, n_dirs) float32 signal of the in-mask voxels, in C order of the volume
+    index : tuple
+        Volume indices of each row of data, to scatter results back to volume space
+    """
+
+    def __init__(self, dwi_file, mask, memmap_file=None, bbox=None):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.index = np.nonzero(self.mask)
+
+        img = nib.load(dwi_file, keep_file_open=True)
+        if bbox is None:
+            bbox = tuple(slice(0, n) for n in img.shape[:3])
+        crop_shape = tuple(len(range(*sl.indices(n))) for sl, n in zip(bbox, img.shape))
+        if crop_shape != self.mask.shape:
+            raise ValueError(
+                f"Mask shape {self.mask.shape} does not match dwi shape {crop_shape}"
+            )
+        shape = (len(self.index[0]), img.shape[3])
+        if memmap_file is None:
+            self.data = np.empty(shape, dtype=np.float32)
+        else:
+            self.data = np.lib.format.open_memmap(
+                memmap_file, mode="w+", dtype=np.float32, shape=shape
+            )
+        for vol in range(shape[1]):
+            self.data[:, vol] = np.asanyarray(img.dataobj[bbox + (vol,)])[self.mask]
+
+    def scatter(self, values, fill=0):
+        """Places per-voxel values back into volume space
+
+        Parameters
+        ----------
+        values : ndarray
+            Array with one row per in-mask voxel
+        fill : scalar, optional
+            Value outside of the mask, by default 0
+
+        Returns
+        -------
+        ndarray
+            Volume shaped like the mask plus the trailing dimensions of values
+        """
+        out = np.full(self.mask.shape + values.shape[1:], fill, dtype=values.dtype)
+        out[self.index] = values
+        return out
+
+
+# Block fitting function and volume shared with forked fitting workers, see `fit_blocks`
+_FIT = None
+
+
+def _fit_block(block):
+    """Fits one block of voxels with the fitting function inherited from the parent process"""
+    fit_block, data = _FIT
+    start, stop = block
+    # voxels are stored as float32, but fit in double precision like the full volume was
+    return fit_block(data[start:stop].astype(np.float64))
+
+
+def fit_blocks(fit_block, dwi, n_cpus=1, block_size=5000):
+    """Fits a model over the voxels of a MaskedDWI block by block, in a pool of forked processes.
+    Workers inherit the voxels instead of receiving them, and only copy out the rows of the block they fit,
+    so their memory is bounded by block_size. Results are written into preallocated output volumes.
+
+    Parameters
+    ----------
+    fit_block : callable
+        Takes an (n_voxels, n_directions) array and returns a tuple of arrays with n_voxels rows
+    dwi : MaskedDWI
+        In-mask voxels to fit
+    n_cpus : int, optional
+        Number of processes to fit blocks with, by default 1
+    block_size : int, optional
+        Maximum number of voxels per block, by default 5000
+
+    Returns
+    -------
+    list
+        One volume per output of fit_block, shaped like the mask plus the output's trailing dimensions,
+        and zero outside of the mask
+    """
+    global _FIT
+
+    n_vox = len(dwi.data)
+    n_blocks = max(int(np.ceil(n_vox / block_size)), min(n_vox, 4 * n_cpus), 1)
+    bounds = np.linspace(0, n_vox, n_blocks + 1).astype(int)
+    blocks = list(zip(bounds[:-1], bounds[1:]))
+
+    outputs = []
+
+    def store(block, result):
+        if not outputs:
+            outputs.extend(
+                np.zeros(dwi.mask.shape + r.shape[1:], r.dtype) for r in result
+            )
+        index = tuple(ix[slice(*block)] for ix in dwi.index)
+        for out, r in zip(outputs, result):
+            out[index] = r
+
+    _FIT = (fit_block, dwi.data)
+    try:
+        if n_cpus > 1:
+            with multiprocessing.get_context("fork").Pool(n_cpus) as pool:
+                for block, result in zip(blocks, pool.imap(_fit_block, blocks)):
+                    store(block, result)
+        else:
+            for block in blocks:
+                store(block, _fit_block(block))
+    finally:
+        _FIT = None
+    return outputs
+
+
+def _peaks_block(model, sphere, data):
+    """Fits the model and finds ODF peaks in a block of voxels
+
+    Peak values are left unnormalized and qa is returned before its division by the maximum peak value,
+    so both can be normalized over the whole volume once every block is done.
+
+    Parameters
+    ----------
+    model : OdfModel
+        Diffusion model to fit
+    sphere : Sphere
+        Sphere to find the peaks on
+    data : ndarray
+        (n_voxels, n_directions) dwi signal
+
+    Returns
+    -------
+    tuple
+        peak_dirs, peak_values, peak_indices, gfa, raw qa and shm_coeff of every voxel
+    """
+    params = dict(PEAKS_PARAMS, normalize_peaks=False)
+    pam = peaks_from_model(model, data, sphere, return_sh=True, **params)
+
+    # undo the division of qa by this block's maximum peak value
+    found = pam.peak_indices[:, 0] >= 0
+    qa = pam.qa * pam.peak_values[found, 0].max() if found.any() else pam.qa
+    return pam.peak_dirs, pam.peak_values, pam.peak_indices, pam.gfa, qa, pam.shm_coeff
+
+
+def _shm_block(model, data):
+    """Fits the model in a block of voxels, returning its (n_voxels, n_coeffs) ODF spherical harmonic coefficients"""
+    return (model.fit(data).shm_coeff,)
+
+
+def _tensor_block(model, data):
+    """Fits the tensor model in a block of voxels, returning its (n_voxels, 12) parameters"""
+    return (model.fit(data).model_params,)
+
+
+def fit_peaks(model, dwi, sphere, n_cpus=1):
+    """Block-parallel equivalent of peaks_from_model with PEAKS_PARAMS and return_sh=True
+
+    Parameters
+    ----------
+    model : OdfModel
+        Diffusion model to fit
+    dwi : MaskedDWI
+        In-mask voxels to fit
+    sphere : Sphere
+        Sphere to find the peaks on
+    n_cpus : int, optional
+        Number of processes to fit with, by default 1
+
+    Returns
+    -------
+    PeaksAndMetrics
+        Peaks, metrics and ODF spherical harmonic coefficients in every voxel
+    """
+    block = partial(_peaks_block, model, sphere)
+    peak_dirs, peak_values, peak_indices, gfa, qa, shm_coeff = fit_blocks(
+        block, dwi, n_cpus
+    )
+    peak_indices[~dwi.mask] = -1
+
+    # qa and peak normalization over the whole volume, as peaks_from_model does
+    found = peak_indices[..., 0] >= 0
+    if found.any():
+        qa /= peak_values[found, 0].max()
+    if PEAKS_PARAMS["normalize_peaks"]:
+        np.divide(
+            peak_values, peak_values[..., :1], out=peak_values, where=found[..., None]
+        )
+        peak_dirs *= peak_values[..., None]
+
+    B = _sh_to_sf(sphere, PEAKS_PARAMS["sh_order"])
+    arrays = dict(
+        peak_dirs=peak_dirs,
+        peak_values=peak_values,
+        peak_indices=peak_indices,
+        gfa=gfa,
+        qa=qa,
+        shm_coeff=shm_coeff,
+        B=B,
+    )
+    return _peaks_and_metrics(sphere, arrays)
+
+
+def fit_shm(model, dwi, n_cpus=1):
+    """Block-parallel fit of the ODF spherical harmonic coefficients of a model, without finding its peaks
+
+    Parameters
+    ----------
+    model : OdfModel
+        Diffusion model to fit
+    dwi : MaskedDWI
+        In-mask voxels to fit
+    n_cpus : int, optional
+        Number of processes to fit with, by default 1
+
+    Returns
+    -------
+    ndarray
+        ODF spherical harmonic coefficients in every voxel, zero outside of the mask
+    """
+    (shm_coeff,) = fit_blocks(partial(_shm_block, model), dwi, n_cpus)
+    return shm_coeff
+
+
+def fit_qa_peaks(model, dwi, sphere):
+    """Finds the largest model peak only in the voxels shown by the qa figure of `qa_tensor.create_qa_figure`
 
-def build_seed_list(mask_img_file, stream_affine, dens):
+    Parameters
+    ----------
+    model : OdfModel
+        Diffusion model to fit
+    dwi : MaskedDWI
+        In-mask voxels to fit
+    sphere : Sphere
+        Sphere to find the peaks on
+
+    Returns
+    -------
+    tuple
+        peak_dirs and peak_values volumes holding the largest peak, zero outside of the qa figure slices
+    """
+    shown = np.zeros(dwi.mask.shape, dtype=bool)
+    for axis, positions in enumerate(qa_tensor.slice_positions(dwi.mask.shape)):
+        index = [slice(None)] * 3
+        index[axis] = positions
+        shown[tuple(index)] = True
+    (rows,) = np.nonzero(shown[dwi.index])
+
+    peak_dirs = np.zeros(dwi.mask.shape + (1, 3))
+    peak_values = np.zeros(dwi.mask.shape + (1,))
+    if len(rows) > 0:
+        pam = peaks_from_model(
+            model, dwi.data[rows].astype(np.float64), sphere, **PEAKS_PARAMS
+        )
+        index = tuple(ix[rows] for ix in dwi.index)
+        peak_dirs[index] = pam.peak_dirs[:, :1]
+        peak_values[index] = pam.peak_values[:, :1]
+    return peak_dirs, peak_values
+
+
+def fit_tensor(model, dwi, n_cpus=1):
+    """Block-parallel equivalent of model.fit(data, mask) for a TensorModel
+
+    Parameters
+    ----------
+    model : TensorModel
+        Tensor model to fit
+    dwi : MaskedDWI
+        In-mask voxels to fit
+    n_cpus : int, optional
+        Number of processes to fit with, by default 1
+
+    Returns
+    -------
+    TensorFit
+        Tensor fit over the whole volume, zero outside of the mask
+    """
+    (params,) = fit_blocks(partial(_tensor_block, model), dwi, n_cpus)
+    return TensorFit(model, params)
+
+
+def build_seed_list(mask_img_file, stream_affine, dens, random_seed=None):
     """uses dipy tractography utilities in order to create a seed list for tractography
 
     Parameters
@@ -46,6 +665,8 @@ def build_seed_list(mask_img_file, stream_affine, dens):
         4x4 array with 1s diagonally and 0s everywhere else
     dens : int
         seed density
+    random_seed : int, optional
+        Seed for the random placement of the seeds within each voxel, by default None
 
     Returns
     -------
@@ -60,11 +681,12 @@ def build_seed_list(mask_img_file, stream_affine, dens):
         affine=stream_affine,
         seeds_count=int(dens),
         seed_count_per_voxel=True,
+        random_seed=random_seed,
     )
     return seeds
 
 
-def tens_mod_fa_est(gtab, dwi_file, B0_mask):
+def tens_mod_fa_est(gtab, dwi_file, B0_mask, n_cpus=1):
     """Estimate a tensor FA image to use for registrations using dipy functions
 
     Parameters
@@ -75,6 +697,8 @@ def tens_mod_fa_est(gtab, dwi_file, B0_mask):
         Path to eddy-corrected and RAS reoriented dwi image
     B0_mask : str
         Path to nodif B0 mask (averaged b0 mask)
+    n_cpus : int, optional
+        Number of processes to fit the tensor model with, by default 1
 
     Returns
     -------
@@ -82,14 +706,12 @@ def tens_mod_fa_est(gtab, dwi_file, B0_mask):
         Path to tensor_fa image file
     """
 
-    data = nib.load(dwi_file).get_fdata()
-
     print("Generating simple tensor FA image to use for registrations...")
     nodif_B0_img = nib.load(B0_mask)
     B0_mask_data = nodif_B0_img.get_fdata().astype("bool")
     nodif_B0_affine = nodif_B0_img.affine
-    model = TensorModel(gtab)
-    mod = model.fit(data, B0_mask_data)
+    model = diffusion_model("tensor", gtab)
+    mod = fit_tensor(model, MaskedDWI(dwi_file, B0_mask_data), n_cpus)
     FA = fractional_anisotropy(mod.evals)
     FA[np.isnan(FA)] = 0
     fa_img = nib.Nifti1Image(FA.astype(np.float32), nodif_B0_affine)
@@ -114,6 +736,10 @@ class RunTrack:
         qa_tensor_out,
         seeds,
         stream_affine,
+        n_cpus=1,
+        random_seed=None,
+        cache_dir=None,
+        cache_float32=False,
     ):
         """A class for deterministic tractography in native space
 
@@ -150,11 +776,23 @@ class RunTrack:
         mod_func : str
             Diffusion model: csd or csa
         qa_tensor: str
-            path to store the qa for tensor/directions of model
+            path to store the qa for tensor/directions of model, or None to skip the qa figure
         seeds : ndarray
             ndarray of seeds for tractography
         stream_affine : ndarray
             4x4 2D array with 1s diagonaly and 0s everywhere else
+        n_cpus : int, optional
+            Number of processes to track seed shards with, by default 1
+        random_seed : int, optional
+            Seed for dipy's per-seed random number generation, making tractography reproducible
+            regardless of n_cpus. Without it, each seed shard is still seeded from its index, by default None
+        cache_dir : str, optional
+            Directory (e.g. dwi/tensor) to cache model peaks in, so reruns with other seeds or tracking
+            settings skip the model fit, by default None
+        cache_float32 : bool, optional
+            Store the cached peak directions, values, metrics and coefficients as float32, a quarter of the size
+            on disk. Tracking then uses the rounded fit on the first run too, so its streamlines differ slightly
+            from those of a float64 fit, by default False
         """
 
         self.dwi = dwi_in
@@ -170,15 +808,19 @@ class RunTrack:
         self.seeds = seeds
         self.mod_func = mod_func
         self.stream_affine = stream_affine
+        self.n_cpus = int(n_cpus)
+        self.random_seed = random_seed
+        self.cache_dir = cache_dir
+        self.cache_float32 = cache_float32
 
-    @timer
-    def run(self):
-        """Creates the tracktography tracks using dipy commands and the specified tracking type and approach
+    def _tracker(self):
+        """Prepares the stopping criterion and diffusion model, then builds the streamline generator
+        factory for the specified tracking type and approach
 
         Returns
         -------
-        ArraySequence
-            contains the tractography track raw data for further analysis
+        callable
+            Builds a dipy streamline generator when called with seeds=...
 
         Raises
         ------
@@ -194,9 +836,9 @@ class RunTrack:
             elif self.mod_func == "csd":
                 self.mod = self.csd_mod_est()
             if self.track_type == "local":
-                tracks = self.local_tracking()
+                tracker = self.local_tracker()
             elif self.track_type == "particle":
-                tracks = self.particle_tracking()
+                tracker = self.particle_tracker()
             else:
                 raise ValueError(
                     "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
@@ -207,15 +849,114 @@ class RunTrack:
             elif self.mod_func == "csd":
                 self.mod = self.csd_mod_est()
             if self.track_type == "local":
-                tracks = self.local_tracking()
+                tracker = self.local_tracker()
             elif self.track_type == "particle":
-                tracks = self.particle_tracking()
+                tracker = self.particle_tracker()
         else:
             raise ValueError(
                 "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
             )
-        tracks = Streamlines([track for track in tracks if len(track) > 60])
-        return tracks
+        return tracker
+
+    @timer
+    def run(self):
+        """Creates the tracktography tracks using dipy commands and the specified tracking type and approach
+
+        Returns
+        -------
+        ArraySequence
+            contains the tractography track raw data for further analysis
+        """
+        return self.track(self._tracker())
+
+    @timer
+    def save_tracks(self, trk_file, hdr, batch_size=10000):
+        """Runs tractography like `run`, but appends each batch of streamlines to a .trk file as soon as
+        it is tracked and filtered, so the full tractogram is never held in memory
+
+        Parameters
+        ----------
+        trk_file : str
+            Path of the .trk file to write
+        hdr : Nifti1Header
+            Header of the dwi image the streamlines are tracked in
+        batch_size : int, optional
+            Number of seeds tracked per batch, by default 10000
+
+        Returns
+        -------
+        str
+            Path to the .trk file
+        """
+        batches = self.track_batches(self._tracker(), batch_size)
+        return self.write_trk(batches, trk_file, hdr)
+
+    @timer
+    def track_connectomes(self, accumulator, trk_file=None, hdr=None, batch_size=10000):
+        """Runs tractography like `run`, adding each batch of streamlines to connectome edge counts
+        as soon as it is tracked, then discarding it. Writing the streamlines to a .trk file is optional.
+
+        Parameters
+        ----------
+        accumulator : ConnectomeAccumulator
+            Edge counts of every parcellation, from `m2g.graph`
+        trk_file : str, optional
+            Path of a .trk file to also write the streamlines to, by default None
+        hdr : Nifti1Header, optional
+            Header of the dwi image the streamlines are tracked in, required with trk_file, by default None
+        batch_size : int, optional
+            Number of seeds tracked per batch, by default 10000
+
+        Returns
+        -------
+        ConnectomeAccumulator
+            The accumulator, with every streamline counted
+        """
+
+        def counted(batches):
+            for batch in batches:
+                accumulator.add(batch)
+                yield batch
+
+        batches = counted(self.track_batches(self._tracker(), batch_size))
+        if trk_file is None:
+            for _ in batches:
+                pass
+        else:
+            self.write_trk(batches, trk_file, hdr)
+        print(f"# of Streamlines: {accumulator.n_streamlines}")
+        return accumulator
+
+    def write_trk(self, batches, trk_file, hdr):
+        """Writes batches of streamlines to a .trk file one at a time
+
+        Parameters
+        ----------
+        batches : iterable
+            Batches of streamlines, e.g. from `track_batches`
+        trk_file : str
+            Path of the .trk file to write
+        hdr : Nifti1Header
+            Header of the dwi image the streamlines are tracked in
+
+        Returns
+        -------
+        str
+            Path to the .trk file
+        """
+
+        def streamlines():
+            for batch in batches:
+                yield from batch
+
+        # nb_streamlines is patched in by TrkFile once every batch has been written
+        trk_hdr = self.make_hdr(None, hdr)
+        tractogram = nib.streamlines.LazyTractogram(
+            streamlines, affine_to_rasmm=trk_hdr["voxel_to_rasmm"]
+        )
+        trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
+        nib.streamlines.save(trkfile, trk_file)
+        return trk_file
 
     @staticmethod
     def make_hdr(streamlines, hdr):
@@ -231,7 +972,9 @@ class RunTrack:
         ).astype("float32")
         trk_hdr["endianness"] = "<"
         trk_hdr["_offset_data"] = 1000
-        trk_hdr["nb_streamlines"] = streamlines.total_nb_rows
+        trk_hdr["nb_streamlines"] = (
+            0 if streamlines is None else streamlines.total_nb_rows
+        )
 
         return trk_hdr
 
@@ -250,8 +993,6 @@ class RunTrack:
         elif self.track_type == "particle":
             tiss_class = "cmc"
 
-        self.dwi_img = nib.load(self.dwi)
-        self.data = self.dwi_img.get_data()
         # Loads mask and ensures it's a true binary mask
         self.mask_img = nib.load(self.nodif_B0_mask)
         self.mask = self.mask_img.get_data() > 0
@@ -260,11 +1001,32 @@ class RunTrack:
         self.gm_mask_data = self.gm_mask.get_data()
         self.wm_mask = nib.load(self.wm_in_dwi)
         self.wm_mask_data = self.wm_mask.get_data()
-        self.wm_in_dwi_data = nib.load(self.wm_in_dwi).get_data().astype("bool")
-        if tiss_class == "act":
+        tissues = [self.mask, self.gm_mask_data, self.wm_mask_data]
+        if tiss_class in ["act", "cmc"]:
             self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
             self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
-            self.background = np.ones(self.gm_mask.shape)
+            tissues.append(self.vent_csf_in_dwi_data)
+
+        # Crops every volume to the brain, tracking in the cropped grid through a shifted affine
+        # so streamlines still come out in the space of stream_affine
+        self.bbox = bounding_box(*tissues)
+        self.mask = self.mask[self.bbox]
+        self.gm_mask_data = self.gm_mask_data[self.bbox]
+        self.wm_mask_data = self.wm_mask_data[self.bbox]
+        if tiss_class in ["act", "cmc"]:
+            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi_data[self.bbox]
+        shift = np.eye(4)
+        shift[:3, 3] = [sl.start for sl in self.bbox]
+        self.track_affine = np.dot(self.stream_affine, shift)
+        print(
+            f"Cropped diffusion volumes from {self.mask_img.shape[:3]} to {self.mask.shape}"
+        )
+
+        self.wm_in_dwi_data = self.wm_mask_data.astype("bool")
+        # Only the white matter voxels of the dwi are ever fit, so only those are loaded
+        self.masked_dwi = MaskedDWI(self.dwi, self.wm_in_dwi_data, bbox=self.bbox)
+        if tiss_class == "act":
+            self.background = np.ones(self.gm_mask_data.shape)
             self.background[
                 (self.gm_mask_data + self.wm_mask_data + self.vent_csf_in_dwi_data) > 0
             ] = 0
@@ -278,8 +1040,6 @@ class RunTrack:
             self.tiss_classifier = BinaryStoppingCriterion(self.wm_in_dwi_data)
             # self.tiss_classifier = BinaryStoppingCriterion(self.mask)
         elif tiss_class == "cmc":
-            self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
-            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
             voxel_size = np.average(self.wm_mask.get_header()["pixdim"][1:4])
             step_size = 0.2
             self.tiss_classifier = CmcStoppingCriterion.from_pve(
@@ -297,11 +1057,11 @@ class RunTrack:
     def tens_mod_est(self):
 
         print("Fitting tensor model...")
-        self.model = TensorModel(self.gtab)
-        self.ten = self.model.fit(self.data, self.wm_in_dwi_data)
+        self.model = diffusion_model("tensor", self.gtab)
+        self.ten = fit_tensor(self.model, self.masked_dwi, self.n_cpus)
         self.fa = self.ten.fa
         self.fa[np.isnan(self.fa)] = 0
-        self.sphere = get_sphere("repulsion724")
+        self.sphere = load_sphere("repulsion724")
         self.ind = quantize_evecs(self.ten.evecs, self.sphere.vertices)
         return self.ten
 
@@ -309,198 +1069,342 @@ class RunTrack:
     def odf_mod_est(self):
 
         print("Fitting CSA ODF model...")
-        self.mod = CsaOdfModel(self.gtab, sh_order=6)
+        self.mod = diffusion_model("csa", self.gtab, sh_order=6)
         return self.mod
 
     @timer
     def csd_mod_est(self):
+        """Builds a CSD model from the recursive response function of the subject's white matter.
+        The response depends on the data, so unlike `diffusion_model` the CSD model is not reused across subjects
 
+        Returns
+        -------
+        ConstrainedSphericalDeconvModel
+            CSD model of the subject
+        """
         print("Fitting CSD model...")
-        try:
-            print("Attempting to use spherical harmonic basis first...")
-            self.mod = ConstrainedSphericalDeconvModel(self.gtab, None, sh_order=6)
-        except:
-            print("Falling back to estimating recursive response...")
-            self.response = recursive_response(
-                self.gtab,
-                self.data,
-                mask=self.wm_in_dwi_data,
-                sh_order=6,
-                peak_thr=0.01,
-                init_fa=0.08,
-                init_trace=0.0021,
-                iter=8,
-                convergence=0.001,
-                parallel=False,
-            )
-            print("CSD Reponse: " + str(self.response))
-            self.mod = ConstrainedSphericalDeconvModel(
-                self.gtab, self.response, sh_order=6
-            )
+        print("Estimating recursive response...")
+        self.response = recursive_response(
+            self.gtab,
+            self.masked_dwi.data,
+            sh_order=6,
+            peak_thr=0.01,
+            init_fa=0.08,
+            init_trace=0.0021,
+            iter=8,
+            convergence=0.001,
+            parallel=False,
+        )
+        print("CSD Reponse: " + str(self.response))
+        self.mod = ConstrainedSphericalDeconvModel(self.gtab, self.response, sh_order=6)
         return self.mod
 
-    @timer
     def local_tracking(self):
+        """Tracks streamlines from every seed with LocalTracking
 
-        self.sphere = get_sphere("repulsion724")
-        if self.mod_type == "det":
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            self.streamline_generator = LocalTracking(
-                self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                step_size=0.5,
-                return_all=True,
-            )
-        elif self.mod_type == "prob":
-            print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = LocalTracking(
-                self.pdg,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                step_size=0.5,
-                return_all=True,
-            )
-        print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
+        Returns
+        -------
+        ArraySequence
+            Streamlines long enough to keep, in seed order
+        """
+        self.streamlines = self.track(self.local_tracker())
         return self.streamlines
 
     @timer
+    def local_tracker(self):
+        """Fits the model and builds the direction getter for LocalTracking
+
+        Returns
+        -------
+        callable
+            Builds a LocalTracking streamline generator when called with seeds=...
+        """
+        return partial(
+            LocalTracking,
+            self.direction_getter(),
+            self.tiss_classifier,
+            affine=self.track_affine,
+            step_size=0.5,
+            return_all=True,
+            random_seed=self.track_random_seed(),
+        )
+
     def particle_tracking(self):
+        """Tracks streamlines from every seed with ParticleFilteringTracking
 
-        self.sphere = get_sphere("repulsion724")
+        Returns
+        -------
+        ArraySequence
+            Streamlines long enough to keep, in seed order
+        """
+        self.streamlines = self.track(self.particle_tracker())
+        return self.streamlines
+
+    @timer
+    def particle_tracker(self):
+        """Fits the model and builds the direction getter for ParticleFilteringTracking
+
+        Returns
+        -------
+        callable
+            Builds a ParticleFilteringTracking streamline generator when called with seeds=...
+        """
+        maxcrossing = 1 if self.mod_type == "det" else 2
+        return partial(
+            ParticleFilteringTracking,
+            self.direction_getter(),
+            self.tiss_classifier,
+            affine=self.track_affine,
+            max_cross=maxcrossing,
+            step_size=0.5,
+            maxlen=1000,
+            pft_back_tracking_dist=2,
+            pft_front_tracking_dist=1,
+            particle_count=15,
+            return_all=True,
+            random_seed=self.track_random_seed(),
+        )
+
+    def track_random_seed(self):
+        """dipy reseeds its random number generators from the sum of the voxel coordinates of each seed
+        plus random_seed, so random_seed is shifted by the crop origin. The sums only match those of the
+        uncropped volume exactly for the seeds of `track_seeds`
+
+        Returns
+        -------
+        int or None
+            Random seed for the tracking in the cropped volume
+        """
+        if self.random_seed is None:
+            return None
+        return self.random_seed + sum(sl.start for sl in self.bbox)
+
+    def track_seeds(self):
+        """Seeds to track from. With a random_seed, they are moved onto a grid of 2**-16 voxel, half a grid
+        step off the voxel borders, so their coordinates shift exactly with the crop origin and dipy draws the
+        same random numbers for them as in the uncropped volume (see `track_random_seed`). This holds when
+        stream_affine maps seeds to voxel coordinates exactly, like the identity the pipeline tracks with;
+        seeds move by at most 2**-17 voxel. Positions along the streamlines still differ from the uncropped
+        volume in their last bits, which particle filtering with probabilistic directions can amplify into
+        different streamlines for a few seeds
+
+        Returns
+        -------
+        ndarray
+            Seed points, in the space of stream_affine
+        """
+        if self.random_seed is None:
+            return self.seeds
+        return (np.floor(np.asarray(self.seeds) * 2**16) + 0.5) / 2**16
+
+    def direction_getter(self):
+        """Builds the direction getter for the tracking type: the model peaks for deterministic tracking,
+        or a probabilistic direction getter on the spherical harmonic coefficients of the model
+
+        Returns
+        -------
+        PeaksAndMetrics or ProbabilisticDirectionGetter
+            Direction getter for dipy's tracking
+        """
         if self.mod_type == "det":
-            maxcrossing = 1
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
-            )
-        elif self.mod_type == "prob":
-            maxcrossing = 2
-            print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.pdg,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
-            )
+            self.mod_peaks = self.model_peaks()
+            self.qa_figure(self.mod_peaks.peak_dirs, self.mod_peaks.peak_values)
+            return self.mod_peaks
+
+        print("Preparing probabilistic tracking...")
+        shm_coeff = self.model_shm()
+        if self.qa_tensor_out is not None:
+            # Tracking never uses the peaks, so they are only found where the qa figure shows them
+            print("Obtaining peaks from model on the QA figure slices...")
+            self.qa_figure(*fit_qa_peaks(self.mod, self.masked_dwi, self.sphere))
+
+        print("Building direction-getter...")
+        print(
+            "Proceeding using spherical harmonic coefficient from model estimation..."
+        )
+        # The PMF is evaluated from the coefficients of each voxel as tracking reaches it, so a dense
+        # (x, y, z, n_vertices) PMF is never built
+        self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
+            np.ascontiguousarray(shm_coeff, dtype=np.float64),
+            max_angle=60.0,
+            sphere=self.sphere,
+        )
+        return self.pdg
+
+    def qa_figure(self, peak_dirs, peak_values):
+        """Draws the qa figure of the model peak directions to qa_tensor_out, unless it is None
+
+        Parameters
+        ----------
+        peak_dirs : ndarray
+            Peak directions in every voxel
+        peak_values : ndarray
+            Peak values in every voxel
+        """
+        if self.qa_tensor_out is None:
+            return
+        qa_tensor.create_qa_figure(
+            peak_dirs, peak_values, self.qa_tensor_out, self.mod_func
+        )
+
+    @timer
+    def model_peaks(self):
+        """Fits the diffusion model over the white matter and finds its peaks, keeping the spherical harmonic
+        coefficients of the ODF. With a cache_dir, results are saved under a key derived from the dwi data,
+        gradient table, mask and model parameters, and loaded back instead of refitting on later runs.
+
+        Returns
+        -------
+        PeaksAndMetrics
+            Peaks, metrics and ODF spherical harmonic coefficients in every voxel
+        """
+        self.sphere = load_sphere("repulsion724")
+
+        cache_file = None
+        if self.cache_dir is not None:
+            (cache_file,) = self.cache_files("peaks")
+            if os.path.isfile(cache_file):
+                print(f"Loading cached model peaks from {cache_file}...")
+                return _load_peaks(cache_file, self.sphere)
+
+        print("Obtaining peaks from model...")
+        pam = fit_peaks(self.mod, self.masked_dwi, self.sphere, self.n_cpus)
+        if cache_file is not None:
+            pam = _save_peaks(pam, cache_file, float32=self.cache_float32)
+            print(f"Model peaks saved to {cache_file}")
+        return pam
+
+    @timer
+    def model_shm(self):
+        """Fits the ODF spherical harmonic coefficients of the diffusion model over the white matter, without
+        finding its peaks. With a cache_dir, coefficients are loaded back from an earlier fit of the coefficients
+        alone or from cached model peaks, and saved otherwise.
+
+        Returns
+        -------
+        ndarray
+            ODF spherical harmonic coefficients in every voxel
+        """
+        self.sphere = load_sphere("repulsion724")
+
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file, peaks_file = self.cache_files("shm", "peaks")
+            for cached in [cache_file, peaks_file]:
+                if os.path.isfile(cached):
+                    print(f"Loading cached model coefficients from {cached}...")
+                    return _load_npz(cached, ["shm_coeff"])["shm_coeff"]
+
+        print("Fitting spherical harmonic coefficients of the model...")
+        shm_coeff = fit_shm(self.mod, self.masked_dwi, self.n_cpus)
+        if cache_file is not None:
+            shm_coeff = _save_npz(
+                cache_file, float32=self.cache_float32, shm_coeff=shm_coeff
+            )["shm_coeff"]
+            print(f"Model coefficients saved to {cache_file}")
+        return shm_coeff
+
+    def cache_files(self, *kinds):
+        """Paths of model fits in cache_dir
+
+        Parameters
+        ----------
+        kinds : str
+            "peaks" for `model_peaks`, or "shm" for `model_shm`
+
+        Returns
+        -------
+        list
+            Path of the .npz file of each kind
+        """
+        key = self.peaks_key()
+        return [
+            os.path.join(self.cache_dir, f"{kind}_{self.mod_func}_{key}.npz")
+            for kind in kinds
+        ]
+
+    def peaks_key(self):
+        """Hash of everything the model peaks depend on: dwi data, gradient table, white matter mask,
+        diffusion model and peak extraction parameters. The in-mask dwi voxels are hashed rather than the dwi
+        file's path and modification time, since the pipeline rewrites the preprocessed dwi on every run.
+        This reads through the whole masked array once per call, a fraction of a second per 100 MB.
+
+        Returns
+        -------
+        str
+            Hex digest identifying the model fit
+        """
+        key = hashlib.sha1()
+        for arr in [
+            self.masked_dwi.data,
+            self.masked_dwi.mask,
+            self.gtab.bvals,
+            self.gtab.bvecs,
+        ]:
+            arr = np.ascontiguousarray(arr)
+            key.update(f"{arr.dtype}{arr.shape}".encode())
+            key.update(arr.data)
+        key.update(f"{self.mod_func}{sorted(PEAKS_PARAMS.items())}".encode())
+        key.update(dipy.__version__.encode())
+        return key.hexdigest()[:16]
+
+    def track(self, tracker):
+        """Tracks streamlines from every seed, keeping those long enough for the tractogram
+
+        Parameters
+        ----------
+        tracker : callable
+            Builds a dipy streamline generator when called with seeds=...
+
+        Returns
+        -------
+        ArraySequence
+            Streamlines from every seed, in seed order
+        """
+        streamlines = Streamlines()
+        for batch in self.track_batches(tracker):
+            streamlines.extend(batch)
+        return streamlines
+
+    def track_batches(self, tracker, batch_size=10000):
+        """Tracks streamlines from every seed in batches, dropping short streamlines as each batch completes.
+        With n_cpus > 1 the seeds are split into shards that are tracked in a pool of forked processes,
+        which inherit the direction getter and stopping criterion instead of rebuilding them. Each shard's
+        random number generator is seeded from random_seed (or 0) plus the shard index.
+
+        Parameters
+        ----------
+        tracker : callable
+            Builds a dipy streamline generator when called with seeds=...
+        batch_size : int, optional
+            Maximum number of seeds per batch, by default 10000
+
+        Yields
+        ------
+        ArraySequence
+            Streamlines of one batch of seeds, batches following seed order
+        """
+        global _TRACKER
+
         print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
-        return self.streamlines
+        seeds = self.track_seeds()
+        if self.n_cpus <= 1 or len(seeds) < 2:
+            generator = iter(tracker(seeds=seeds))
+            while True:
+                batch = Streamlines(islice(generator, batch_size))
+                if len(batch) == 0:
+                    return
+                yield _keep_long(batch)
+
+        # a few shards per process to balance seeds that track for longer
+        n_shards = max(self.n_cpus * 4, int(np.ceil(len(seeds) / batch_size)))
+        shards = np.array_split(np.asarray(seeds), n_shards)
+        base_seed = 0 if self.random_seed is None else self.random_seed
+        shard_seeds = (base_seed + np.arange(n_shards)) % 2**32
+        print(f"Tracking {len(shards)} seed shards on {self.n_cpus} processes...")
+        _TRACKER = tracker
+        try:
+            with multiprocessing.get_context("fork").Pool(self.n_cpus) as pool:
+                yield from pool.imap(_track_shard, zip(shard_seeds, shards))
+        finally:
+            _TRACKER = None
@@ -5,5 +5,5 @@ m2g.utils
 Small utility functions, for use in larger modules.
 """
 
-__all__ = ["cloud_utils", "gen_utils", "reg_utils"]
+__all__ = ["cloud_utils", "gen_utils", "morph_utils", "reg_utils"]
 from . import *
@@ -29,7 +29,7 @@ from dipy.core.gradients import gradient_table
 from dipy.io import read_bvals_bvecs
 from fury import actor, window
 from nilearn.image import mean_img
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 
 
 class DirectorySweeper:
@@ -903,31 +903,38 @@ def parcel_overlap(parcellation1, parcellation2, outpath):
         the path to produce the output.
     """
 
-    p1_dat = nib.load(parcellation1).get_data()
-    p2_dat = nib.load(parcellation2).get_data()
-    p1regs = np.unique(p1_dat)
+    p1_dat = np.asanyarray(nib.load(parcellation1).dataobj).ravel()
+    p2_dat = np.asanyarray(nib.load(parcellation2).dataobj).ravel()
+
+    # contiguous indices of each label, paired voxelwise into a single joint histogram
+    p1regs, p1_idx = np.unique(p1_dat, return_inverse=True)
+    p2regs, p2_idx = np.unique(p2_dat, return_inverse=True)
+    n2 = len(p2regs)
+    pairs, counts = np.unique(
+        p1_idx.astype(np.int64) * n2 + p2_idx.ravel(), return_counts=True
+    )
+    overlapdat = csr_matrix(
+        (counts, (pairs // n2, pairs % n2)), shape=(len(p1regs), n2)
+    )[p1regs > 0]
     p1regs = p1regs[p1regs > 0]
-    p2regs = np.unique(p2_dat)
 
     p1n = get_filename(parcellation1)
     p2n = get_filename(parcellation2)
 
-    overlapdat = lil_matrix((p1regs.shape[0], p2regs.shape[0]), dtype=np.float32)
-    for p1idx, p1reg in enumerate(p1regs):
-        p1seq = p1_dat == p1reg
-        N = p1seq.sum()
-        poss_regs = np.unique(p2_dat[p1seq])
-        for p2idx, p2reg in enumerate(p2regs):
-            if p2reg in poss_regs:
-                # percent overlap is p1seq and'd with the anatomical region voxelspace, summed and normalized
-                pover = np.logical_and(p1seq, p2_dat == p2reg).sum() / float(N)
-                overlapdat[p1idx, p2idx] = pover
+    # percent of each parcel 1 region that falls in each parcel 2 region
+    N = np.asarray(overlapdat.sum(axis=1)).ravel()
+    overlapdat.data = (
+        overlapdat.data / np.repeat(N, np.diff(overlapdat.indptr))
+    ).astype(np.float32)
 
+    # one row per parcellation 1 region, labelled in the first column
     outf = os.path.join(outpath, f"{p1n}_{p2n}.csv")
-    with open(outf, "w") as f:
-        p2str = [f"{x}" for x in p2regs]
-        f.write("p1reg," + ",".join(p2str) + "\n")
-        for idx, p1reg in enumerate(p1regs):
-            datstr = ["%.4f" % x for x in overlapdat[idx,].toarray()[0,]]
-            f.write(str(p1reg) + "," + ",".join(datstr) + "\n")
-        f.close()
+    label_fmt = "%d" if np.issubdtype(p1regs.dtype, np.integer) else "%s"
+    np.savetxt(
+        outf,
+        np.column_stack([p1regs, overlapdat.toarray()]),
+        fmt=[label_fmt] + ["%.4f"] * n2,
+        delimiter=",",
+        header="p1reg," + ",".join(f"{x}" for x in p2regs),
+        comments="",
+    )
@@ -0,0 +1,156 @@
+"""
+m2g.utils.morph_utils
+~~~~~~~~~~~~~~~~~~~~~~
+
+Contains binary morphology utilities for 3D masks, with precomputed structuring elements.
+"""
+
+# standard library imports
+from functools import lru_cache
+
+# package imports
+import numpy as np
+from scipy import ndimage
+
+# 6-connected (face neighbours) and 26-connected (cube) structuring elements
+CROSS = ndimage.generate_binary_structure(3, 1)
+CUBE = ndimage.generate_binary_structure(3, 3)
+CROSS.flags.writeable = False
+CUBE.flags.writeable = False
+
+
+@lru_cache(maxsize=None)
+def _sphere_kernel(radius, zooms):
+    half = np.floor(radius / np.array(zooms)).astype(int)
+    grid = np.ogrid[tuple(slice(-h, h + 1) for h in half)]
+    dist2 = sum((g * z) ** 2 for g, z in zip(grid, zooms))
+    kernel = dist2 <= radius**2
+    kernel.flags.writeable = False
+    return kernel
+
+
+def sphere_kernel(radius, zooms):
+    """Spherical structuring element, the voxels whose centers lie within radius mm of the central voxel,
+    equivalent to the fslmaths "-kernel sphere" kernel. Kernels are computed once per radius and voxel size
+
+    Parameters
+    ----------
+    radius : float
+        radius of the sphere, in mm
+    zooms : tuple
+        voxel sizes of the image the kernel is applied to, in mm
+
+    Returns
+    -------
+    ndarray
+        read-only boolean structuring element
+    """
+    return _sphere_kernel(float(radius), tuple(float(z) for z in zooms[:3]))
+
+
+def erode(mask, iterations=1, structure=CROSS):
+    """Erodes a mask, keeping the nonzero voxels whose neighbourhood (as given by structure) is entirely nonzero.
+    Voxels outside the volume do not erode the mask
+
+    Parameters
+    ----------
+    mask : ndarray
+        mask to erode, nonzero voxels are part of the mask
+    iterations : int, optional
+        number of times the erosion is repeated, by default 1
+    structure : ndarray, optional
+        structuring element, by default CROSS (the 6 face neighbours)
+
+    Returns
+    -------
+    ndarray
+        boolean eroded mask
+    """
+    mask = np.asanyarray(mask) != 0
+    if iterations < 1:
+        return mask
+    return ndimage.binary_erosion(
+        mask, structure=structure, iterations=iterations, border_value=1
+    )
+
+
+def dilate(mask, iterations=1, structure=CROSS):
+    """Dilates a mask, adding the voxels with a nonzero voxel in their neighbourhood (as given by structure)
+
+    Parameters
+    ----------
+    mask : ndarray
+        mask to dilate, nonzero voxels are part of the mask
+    iterations : int, optional
+        number of times the dilation is repeated, by default 1
+    structure : ndarray, optional
+        structuring element, by default CROSS (the 6 face neighbours)
+
+    Returns
+    -------
+    ndarray
+        boolean dilated mask
+    """
+    mask = np.asanyarray(mask) != 0
+    if iterations < 1:
+        return mask
+    return ndimage.binary_dilation(mask, structure=structure, iterations=iterations)
+
+
+def edge(mask, structure=CROSS):
+    """Inner edge of a mask, the voxels of the mask with a voxel outside the mask in their neighbourhood
+
+    Parameters
+    ----------
+    mask : ndarray
+        mask to extract the edge of, nonzero voxels are part of the mask
+    structure : ndarray, optional
+        structuring element, by default CROSS (the 6 face neighbours)
+
+    Returns
+    -------
+    ndarray
+        boolean edge mask
+    """
+    mask = np.asanyarray(mask) != 0
+    return mask & ~erode(mask, structure=structure)
+
+
+def erode_sphere(mask, radius, zooms):
+    """Erodes a mask with a sphere of radius mm, as fslmaths "-kernel sphere radius -ero" does
+
+    Parameters
+    ----------
+    mask : ndarray
+        mask to erode, nonzero voxels are part of the mask
+    radius : float
+        radius of the sphere, in mm
+    zooms : tuple
+        voxel sizes of the mask, in mm
+
+    Returns
+    -------
+    ndarray
+        boolean eroded mask
+    """
+    return erode(mask, structure=sphere_kernel(radius, zooms))
+
+
+def dilate_sphere(mask, radius, zooms):
+    """Dilates a mask with a sphere of radius mm, as fslmaths "-kernel sphere radius -dilM" does on a binary mask
+
+    Parameters
+    ----------
+    mask : ndarray
+        mask to dilate, nonzero voxels are part of the mask
+    radius : float
+        radius of the sphere, in mm
+    zooms : tuple
+        voxel sizes of the mask, in mm
+
+    Returns
+    -------
+    ndarray
+        boolean dilated mask
+    """
+    return dilate(mask, structure=sphere_kernel(radius, zooms))
@@ -5,6 +5,10 @@ m2g.utils.reg_utils
 Contains small-scale registration utilities.
 """
 
+# standard library imports
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 # package imports
 import nibabel as nib
 import nilearn.image as nl
@@ -22,9 +26,10 @@ from dipy.align.transforms import (
     TranslationTransform3D,
 )
 from dipy.viz import regtools
+from scipy import ndimage
 
 # m2g imports
-from m2g.utils import gen_utils
+from m2g.utils import gen_utils, morph_utils
 from m2g.utils.gen_utils import print_arguments, timer
 
 
@@ -44,39 +49,12 @@ def erode_mask(mask, v=0):
     -------
     numpy array
         eroded mask
-
-    Raises
-    ------
-    ValueError
-        The mask you provided for erosion has an invalid shape (must be x.shape=y.shape=z.shape)
     """
 
+    if v < 1:
+        return mask
     print("Eroding Mask...")
-    for i in range(0, v):
-        # masked_vox is a tuple 0f [x]. [y]. [z] cooords
-        # wherever mask is nonzero
-        erode_mask = np.zeros(mask.shape)
-        x, y, z = np.where(mask != 0)
-        if x.shape == y.shape and y.shape == z.shape:
-            # iterated over all the nonzero voxels
-            for j in range(0, x.shape[0]):
-                # check that the 3d voxels within 1 voxel are 1
-                # if so, add to the new mask
-                md = mask.shape
-                if (
-                    mask[x[j], y[j], z[j]]
-                    and mask[np.min((x[j] + 1, md[0] - 1)), y[j], z[j]]
-                    and mask[x[j], np.min((y[j] + 1, md[1] - 1)), z[j]]
-                    and mask[x[j], y[j], np.min((z[j] + 1, md[2] - 1))]
-                    and mask[np.max((x[j] - 1, 0)), y[j], z[j]]
-                    and mask[x[j], np.max((y[j] - 1, 0)), z[j]]
-                    and mask[x[j], y[j], np.max((z[j] - 1, 0))]
-                ):
-                    erode_mask[x[j], y[j], z[j]] = 1
-        else:
-            raise ValueError("Your mask erosion has an invalid shape.")
-        mask = erode_mask
-    return mask
+    return morph_utils.erode(mask, iterations=v).astype(float)
 
 
 @print_arguments(inputs=[0], outputs=[1])
@@ -99,11 +77,8 @@ def probmap2mask(prob_map, mask_path, t, erode=0):
     """
     print(f"Extracting Mask from probability map {prob_map}...")
     prob = nib.load(prob_map)
-    prob_dat = prob.get_data()
-    mask = (prob_dat > t).astype(int)
-    if erode > 0:
-        mask = erode_mask(mask, v=erode)
-    img = nib.Nifti1Image(mask, header=prob.header, affine=prob.get_affine())
+    mask = morph_utils.erode(prob.get_fdata() > t, iterations=erode).astype(int)
+    img = nib.Nifti1Image(mask, header=prob.header, affine=prob.affine)
     # save the corrected image
     nib.save(img, mask_path)
     return mask_path
@@ -192,7 +167,59 @@ def resample_fsl(base, res, goal_res, interp="spline"):
     gen_utils.run(cmd)
 
 
-def skullstrip_check(dmrireg, parcellations, outdir, prep_anat, vox_size, reg_style):
+def _align_parcellation(
+    dmrireg, parcellation, outdir, prep_anat, vox_size, dsn, mni2t1_xfm
+):
+    """Aligns one parcellation to dwi space with `skullstrip_check`, warning if it lost an roi
+
+    Parameters
+    ----------
+    dmrireg : DmriReg
+        Registration object of the pipeline
+    parcellation : str
+        Path to the parcellation label file, in MNI space
+    outdir : str
+        Directory the resampled label file is saved in
+    prep_anat : str
+        Path to anatomical preprocessing directory location
+    vox_size : str
+        Target voxel resolution of the parcellation ("4mm", "2mm", or "1mm")
+    dsn : bool
+        Whether the labels are aligned to the dsn (native_dsn) space rather than the native dwi space
+    mni2t1_xfm : str
+        Path to the template to t1_aligned_mni transform, from `DmriReg.mni2t1_aligned_mni_align`
+
+    Returns
+    -------
+    str
+        Path to the aligned label file
+    """
+    labels_im_file = gen_utils.reorient_t1w(parcellation, prep_anat)
+    labels_im_file = gen_utils.match_target_vox_res(
+        labels_im_file, vox_size, outdir, sens="anat_d"
+    )
+    orig_lab = nib.load(labels_im_file)
+    orig_lab = orig_lab.get_data().astype("int")
+    n_ids = orig_lab[orig_lab > 0]
+    num = len(np.unique(n_ids))
+
+    labels_im_file_dwi = dmrireg.atlas2t1w2dwi_align(labels_im_file, mni2t1_xfm, dsn)
+    labels_im = nib.load(labels_im_file_dwi)
+    align_lab = labels_im.get_data().astype("int")
+    n_ids_2 = align_lab[align_lab > 0]
+    num2 = len(np.unique(n_ids_2))
+
+    if num != num2:
+        print(
+            """WARNING: The atlas has lost an roi due to alignment! A file containing the lost ROI values will be generated in the
+        same folder as the connectome output. Try rerunning m2g with the appropriate --skull flag."""
+        )
+    return labels_im_file_dwi
+
+
+def skullstrip_check(
+    dmrireg, parcellations, outdir, prep_anat, vox_size, reg_style, n_cpus=1
+):
     """Peforms the alignment of atlas to dwi space and checks if the alignment results in roi loss
 
     Parameters
@@ -212,11 +239,13 @@ def skullstrip_check(dmrireg, parcellations, outdir, prep_anat, vox_size, reg_st
         prior probability maps if the input T1w MRI is in standard space, by default ""
     reg_style : str
         Tractography space, must be either native or native_dsn
+    n_cpus : int, optional
+        Number of parcellations to align at once, in separate processes, by default 1
 
     Returns
     -------
     list
-        List containing the paths to the aligned label files
+        List containing the paths to the aligned label files, in the order of parcellations
 
     Raises
     ------
@@ -230,31 +259,20 @@ def skullstrip_check(dmrireg, parcellations, outdir, prep_anat, vox_size, reg_st
     else:
         raise ValueError("Unsupported tractography space, must be native or native_dsn")
 
-    labels_im_file_list = []
-    for idx, label in enumerate(parcellations):
-        labels_im_file = gen_utils.reorient_t1w(parcellations[idx], prep_anat)
-        labels_im_file = gen_utils.match_target_vox_res(
-            labels_im_file, vox_size, outdir, sens="anat_d"
-        )
-        orig_lab = nib.load(labels_im_file)
-        orig_lab = orig_lab.get_data().astype("int")
-        n_ids = orig_lab[orig_lab > 0]
-        num = len(np.unique(n_ids))
-
-        labels_im_file_dwi = dmrireg.atlas2t1w2dwi_align(labels_im_file, dsn)
-        labels_im = nib.load(labels_im_file_dwi)
-        align_lab = labels_im.get_data().astype("int")
-        n_ids_2 = align_lab[align_lab > 0]
-        num2 = len(np.unique(n_ids_2))
+    # shared by every parcellation, so estimated once before they are dispatched
+    mni2t1_xfm = dmrireg.mni2t1_aligned_mni_align()
 
-        if num != num2:
-            print(
-                """WARNING: The atlas has lost an roi due to alignment! A file containing the lost ROI values will be generated in the
-            same folder as the connectome output. Try rerunning m2g with the appropriate --skull flag."""
-            )
-
-        labels_im_file_list.append(labels_im_file_dwi)
-    return labels_im_file_list
+    args = [
+        (dmrireg, label, outdir, prep_anat, vox_size, dsn, mni2t1_xfm)
+        for label in parcellations
+    ]
+    n_cpus = min(int(n_cpus), len(parcellations))
+    if n_cpus <= 1:
+        return [_align_parcellation(*arg) for arg in args]
+    with ProcessPoolExecutor(
+        n_cpus, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        return list(executor.map(_align_parcellation, *zip(*args)))
 
 
 @timer
@@ -459,6 +477,104 @@ def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6):
     gen_utils.run(cmd)
 
 
+def fsl_vox2vox(xfm, inp_img, ref_img):
+    """Converts a flirt transform matrix into the affine from voxel indices of the reference image to voxel
+    indices of the input image, the mapping resampling the input onto the reference grid needs
+
+    Parameters
+    ----------
+    xfm : ndarray
+        4x4 flirt transform matrix, from input to reference scaled voxel coordinates
+    inp_img : Nifti1Image
+        input image of the transform
+    ref_img : Nifti1Image
+        reference image of the transform
+
+    Returns
+    -------
+    ndarray
+        4x4 affine matrix
+    """
+    return (
+        np.linalg.inv(fsl_scaled_voxels(inp_img))
+        @ np.linalg.inv(xfm)
+        @ fsl_scaled_voxels(ref_img)
+    )
+
+
+RESAMPLE_ORDERS = {"nearestneighbour": 0, "trilinear": 1}
+
+
+@timer
+def resample_volumes(ref, inputs, xfm, outputs=None, interp="trilinear"):
+    """In-process equivalent of applyxfm for 3D volumes, applying a flirt transform matrix with
+    scipy.ndimage.affine_transform instead of a flirt subprocess. Several volumes can share one call,
+    and aligned volumes can be kept in memory instead of saved.
+
+    Parameters
+    ----------
+    ref : str
+        path of reference image to be aligned to as a nifti image file
+    inputs : str or list
+        path(s) of input images to be aligned as nifti image files
+    xfm : str
+        path to the flirt transform matrix between the input images and the reference image
+    outputs : str or list, optional
+        path(s) for the output aligned images, one per input, with None for images not to save,
+        by default None (no image is saved)
+    interp : str, optional
+        interpolation method, nearestneighbour or trilinear, by default "trilinear"
+
+    Returns
+    -------
+    list
+        aligned Nifti1Image of each input
+
+    Raises
+    ------
+    ValueError
+        Raised for an unsupported interpolation method
+    """
+    if interp not in RESAMPLE_ORDERS:
+        raise ValueError(
+            f"Unsupported interpolation {interp}, must be one of {list(RESAMPLE_ORDERS)}"
+        )
+    if isinstance(inputs, str):
+        inputs, outputs = [inputs], [outputs]
+    if outputs is None:
+        outputs = [None] * len(inputs)
+    order = RESAMPLE_ORDERS[interp]
+
+    ref_img = nib.load(ref)
+    xfm_mat = np.loadtxt(xfm)
+    aligned_imgs = []
+    for inp, out in zip(inputs, outputs):
+        print(f"Resampling {inp} onto {ref} with {xfm}...")
+        img = nib.load(inp)
+        vox2vox = fsl_vox2vox(xfm_mat, img, ref_img)
+        data = np.asanyarray(img.dataobj)
+        if order > 0:
+            data = data.astype(np.float64)
+        aligned = ndimage.affine_transform(
+            data,
+            vox2vox[:3, :3],
+            offset=vox2vox[:3, 3],
+            output_shape=ref_img.shape[:3],
+            order=order,
+            mode="constant",
+            cval=0,
+            prefilter=False,
+        )
+        if order > 0:
+            aligned = aligned.astype(np.float32)
+        aligned_img = nib.Nifti1Image(aligned, ref_img.affine, header=ref_img.header)
+        aligned_img.set_data_dtype(aligned.dtype)
+        if out is not None:
+            nib.save(aligned_img, out)
+        aligned_imgs.append(aligned_img)
+    return aligned_imgs
+
+
 @print_arguments(inputs=[0, 1], outputs=[2, 3])
 def apply_warp(ref, inp, out, warp, xfm=None, mask=None, interp=None, sup=False):
     """Applies a warp from the structural to reference space in a single step using information about
@@ -545,6 +661,58 @@ def resample(base, ingested, template):
     nib.save(target_im, ingested)
 
 
+def fsl_scaled_voxels(img):
+    """Matrix from the voxel indices of an image to the scaled voxel coordinates FSL's transform matrices act on:
+    voxel indices times voxel sizes, with the x axis flipped for images with a positive affine determinant
+
+    Parameters
+    ----------
+    img : Nifti1Image
+        image the coordinates are for
+
+    Returns
+    -------
+    ndarray
+        4x4 affine matrix
+    """
+    scaled = np.diag(list(img.header.get_zooms()[:3]) + [1.0])
+    if np.linalg.det(img.affine) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scaled = scaled @ flip
+    return scaled
+
+
+@print_arguments(inputs=[0, 1, 2], outputs=[3])
+def transfer_xfm(xfm, inp, new_inp, xfm_out):
+    """Rewrites a flirt transform estimated for one input image so it applies to another input image in the
+    same world space, whatever its voxel grid, e.g. to align every parcellation of a template space with
+    the transform of the template
+
+    Parameters
+    ----------
+    xfm : str
+        path to the flirt transform matrix estimated with inp as input
+    inp : str
+        path to the input image xfm was estimated for
+    new_inp : str
+        path to the image in the world space of inp to transform instead
+    xfm_out : str
+        path for the output transform matrix, to be applied with new_inp as input
+    """
+    inp_img = nib.load(inp)
+    new_img = nib.load(new_inp)
+    # new_inp scaled voxels -> world -> inp scaled voxels
+    new2inp = (
+        fsl_scaled_voxels(inp_img)
+        @ np.linalg.inv(inp_img.affine)
+        @ new_img.affine
+        @ np.linalg.inv(fsl_scaled_voxels(new_img))
+    )
+    np.savetxt(xfm_out, np.loadtxt(xfm) @ new2inp, fmt="%.10f", delimiter="  ")
+
+
 @print_arguments(inputs=[0, 1], outputs=[2])
 def combine_xfms(xfm1, xfm2, xfmout):
     """A function to combine two transformations and output the resulting transformation
@@ -1,10 +1,12 @@
 import os
 
+import numpy as np
+import nibabel as nib
 import pytest
 import m2g
 from m2g.utils.cloud_utils import s3_get_data
 from pathlib import Path
-from m2g.utils.gen_utils import create_datadescript, DirectorySweeper
+from m2g.utils.gen_utils import create_datadescript, DirectorySweeper, parcel_overlap
 
 
 @pytest.fixture
@@ -81,4 +83,27 @@ def test_DirectorySweeper(input_dir_tree):
     assert (
         f"{str(input_dir_tree)}/sub-002448/ses-3/dwi/sub-55.nii.gz"
         in sweeper.get_files("002449", "3").values()
-    ) == False
\ No newline at end of file
+    ) == False
+
+
+def test_parcel_overlap(tmp_path):
+    p1 = np.zeros((4, 4, 4), dtype=np.int16)
+    p1[:2] = 1
+    p1[2:, :2] = 2
+    p2 = np.zeros((4, 4, 4), dtype=np.int16)
+    p2[:, :, :1] = 5
+    p2[:, :, 1:] = 9
+    for name, dat in [("p1", p1), ("p2", p2)]:
+        nib.save(nib.Nifti1Image(dat, np.eye(4)), str(tmp_path / f"{name}.nii.gz"))
+
+    parcel_overlap(
+        str(tmp_path / "p1.nii.gz"), str(tmp_path / "p2.nii.gz"), str(tmp_path)
+    )
+    with open(tmp_path / "p1_p2.csv") as f:
+        lines = f.read().splitlines()
+
+    assert lines == [
+        "p1reg,5,9",
+        "1,0.2500,0.7500",
+        "2,0.2500,0.7500",
+    ]
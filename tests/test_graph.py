@@ -0,0 +1,255 @@
+import os
+from collections import defaultdict
+from itertools import combinations
+
+import networkx as nx
+import nibabel as nib
+import numpy as np
+import pytest
+from dipy.tracking.streamline import Streamlines
+from scipy.sparse import load_npz
+
+from m2g.graph import (
+    ConnectomeAccumulator,
+    GraphTools,
+    load_visit_index,
+    make_graphs,
+    save_connectome,
+    write_visit_index,
+)
+
+SHAPE = (20, 22, 18)
+
+
+def reference_connectome(tracks, rois, attr, overlap_thr):
+    """Per-streamline connectome estimation, as m2g used to compute it."""
+    labels = np.unique(attr)
+    node_dict = dict(zip(labels, np.arange(len(labels))))
+    edge_dict = defaultdict(int)
+    for s in tracks:
+        i, j, k = np.floor(s + 0.5).astype(int).T
+        lab_arr = rois[i, j, k]
+        endlabels = [
+            node_dict[lab]
+            for lab in np.unique(lab_arr)
+            if lab > 0 and np.sum(lab_arr == lab) >= overlap_thr
+        ]
+        for edge in combinations(sorted(endlabels), 2):
+            edge_dict[edge] += 1
+
+    A = np.zeros((len(labels), len(labels)))
+    for (a, b), v in edge_dict.items():
+        A[a, b] += v
+        A[b, a] += v
+    return A
+
+
+@pytest.fixture
+def parcellation(tmp_path):
+    rng = np.random.default_rng(0)
+    attr = rng.integers(0, 30, SHAPE) * 2
+    rois = attr.copy()
+    rois[rois == 10] = 0  # an roi lost during registration
+
+    rois_file = str(tmp_path / "rois.nii.gz")
+    attr_file = str(tmp_path / "attr.nii.gz")
+    nib.save(nib.Nifti1Image(rois.astype(np.int32), np.eye(4)), rois_file)
+    nib.save(nib.Nifti1Image(attr.astype(np.int32), np.eye(4)), attr_file)
+
+    tracks = Streamlines(
+        [
+            rng.uniform(0, np.array(SHAPE) - 1, (rng.integers(2, 40), 3))
+            for _ in range(300)
+        ]
+    )
+    return tmp_path, rois_file, attr_file, rois, attr, tracks
+
+
+@pytest.mark.parametrize("overlap_thr", [1, 3])
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_make_graph(parcellation, overlap_thr, n_cpus):
+    tmp_path, rois_file, attr_file, rois, attr, tracks = parcellation
+    g = GraphTools(
+        rois_file,
+        tracks,
+        np.eye(4),
+        tmp_path,
+        str(tmp_path / "connectome.csv"),
+        attr=attr_file,
+        n_cpus=n_cpus,
+    )
+    graph = g.make_graph(error_margin=0, overlap_thr=overlap_thr)
+    A = nx.to_numpy_array(graph, nodelist=range(len(np.unique(attr))))
+
+    assert np.array_equal(A, reference_connectome(tracks, rois, attr, overlap_thr))
+    assert os.path.isfile(tmp_path / "lost_roi.csv")
+
+    g.save_graph(str(tmp_path / "connectome.csv"), fmt=["edgelist", "graphml"])
+    assert os.path.isfile(tmp_path / "connectome.csv")
+    assert os.path.isfile(tmp_path / "connectome.graphml")
+
+
+def test_make_graphs(parcellation):
+    tmp_path, rois_file, attr_file, rois, attr, tracks = parcellation
+
+    # second parcellation: coarser labels in the same space
+    coarse = attr // 4
+    coarse_file = str(tmp_path / "coarse.nii.gz")
+    nib.save(nib.Nifti1Image(coarse.astype(np.int32), np.eye(4)), coarse_file)
+
+    graph_tools = [
+        GraphTools(
+            labels_file,
+            tracks,
+            np.eye(4),
+            tmp_path,
+            str(tmp_path / "connectome.csv"),
+            attr=atlas_file,
+        )
+        for labels_file, atlas_file in [
+            (rois_file, attr_file),
+            (coarse_file, coarse_file),
+        ]
+    ]
+    conn_matrices = make_graphs(graph_tools, error_margin=0, overlap_thr=2)
+
+    for conn_matrix, (labels, atlas) in zip(
+        conn_matrices, [(rois, attr), (coarse, coarse)]
+    ):
+        A = conn_matrix.toarray()
+        assert np.array_equal(A, reference_connectome(tracks, labels, atlas, 2))
+
+
+def test_make_graph_from_trk(parcellation):
+    tmp_path, rois_file, attr_file, rois, attr, tracks = parcellation
+    trk_file = str(tmp_path / "streamlines.trk")
+    hdr = {
+        "dimensions": SHAPE,
+        "voxel_sizes": (1.0, 1.0, 1.0),
+        "voxel_to_rasmm": np.eye(4),
+        "voxel_order": "RAS",
+    }
+    tractogram = nib.streamlines.Tractogram(tracks, affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(nib.streamlines.TrkFile(tractogram, header=hdr), trk_file)
+
+    g = GraphTools(
+        rois_file,
+        trk_file,
+        np.eye(4),
+        tmp_path,
+        str(tmp_path / "connectome.csv"),
+        attr=attr_file,
+    )
+    A = make_graphs([g], error_margin=0, chunk_size=64)[0].toarray()
+
+    assert np.array_equal(A, reference_connectome(tracks, rois, attr, 1))
+
+
+@pytest.mark.parametrize(
+    "error_margin,voxel_size,weight", [(0, 1, 0), (1, 1, 1), (1, 2, 0), (2, 2, 1)]
+)
+def test_make_graph_error_margin(tmp_path, error_margin, voxel_size, weight):
+    rois = np.zeros(SHAPE, dtype=np.int32)
+    rois[5, 5, 5] = 1
+    rois[14, 14, 14] = 2
+    rois_file = str(tmp_path / "rois.nii.gz")
+    nib.save(nib.Nifti1Image(rois, np.eye(4)), rois_file)
+
+    # passes one voxel away from each roi
+    tracks = Streamlines([np.array([[5.0, 6.0, 5.0], [14.0, 13.0, 14.0]])])
+    g = GraphTools(
+        rois_file,
+        tracks,
+        np.eye(4),
+        tmp_path,
+        str(tmp_path / "connectome.csv"),
+        attr=rois_file,
+    )
+    graph = g.make_graph(error_margin=error_margin, voxel_size=voxel_size)
+    A = nx.to_numpy_array(graph, nodelist=range(3))
+
+    assert A[1, 2] == weight
+    assert A.sum() == 2 * weight
+
+    # roi voxels only by default
+    graph = g.make_graph(voxel_size=voxel_size)
+    assert nx.to_numpy_array(graph, nodelist=range(3)).sum() == 0
+
+
+def test_make_graphs_from_visit_index(parcellation):
+    tmp_path, rois_file, attr_file, rois, attr, tracks = parcellation
+    index_file = write_visit_index(
+        tracks, SHAPE, str(tmp_path / "streamlines_visits.npz"), chunk_size=64
+    )
+
+    chunks, shape = load_visit_index(index_file)
+    assert shape == SHAPE
+    assert len(chunks) == 5
+    assert sum(len(offsets) - 1 for offsets, _, _ in chunks) == len(tracks)
+    for offsets, vox, counts in chunks:
+        assert isinstance(vox, np.memmap)
+        assert offsets.dtype == vox.dtype == counts.dtype == np.uint32
+        assert offsets[-1] == len(vox) == len(counts)
+
+    g = GraphTools(
+        rois_file,
+        index_file,
+        np.eye(4),
+        tmp_path,
+        str(tmp_path / "connectome.csv"),
+        attr=attr_file,
+        n_cpus=2,
+    )
+    for overlap_thr in [1, 3]:
+        A = make_graphs([g], error_margin=0, overlap_thr=overlap_thr)[0].toarray()
+        assert np.array_equal(A, reference_connectome(tracks, rois, attr, overlap_thr))
+
+
+def test_save_connectome(tmp_path):
+    rng = np.random.default_rng(0)
+    A = np.triu(rng.integers(0, 4, (12, 12)) * (rng.random((12, 12)) < 0.4), 1)
+    A = (A + A.T).astype(float)
+
+    graphname = str(tmp_path / "connectome.csv")
+    outputs = save_connectome(A, graphname, ["igraph", "npz", "npy", "txt"])
+    assert outputs == [
+        graphname,
+        str(tmp_path / "connectome.npz"),
+        str(tmp_path / "connectome.npy"),
+        str(tmp_path / "connectome.txt"),
+    ]
+
+    # edgelist identical to networkx's
+    expected = str(tmp_path / "expected.csv")
+    nx.write_weighted_edgelist(nx.from_numpy_array(A), expected, delimiter=" ")
+    with open(graphname) as f, open(expected) as g:
+        assert f.read() == g.read()
+
+    assert np.array_equal(load_npz(outputs[1]).toarray(), A)
+    assert np.array_equal(np.load(outputs[2]), A)
+    assert np.array_equal(np.loadtxt(outputs[3]), A)
+
+    with pytest.raises(ValueError):
+        save_connectome(A, graphname, "mat")
+
+
+def test_connectome_accumulator(parcellation):
+    tmp_path, rois_file, attr_file, rois, attr, tracks = parcellation
+    g = GraphTools(
+        rois_file,
+        None,
+        np.eye(4),
+        tmp_path,
+        str(tmp_path / "connectome.csv"),
+        attr=attr_file,
+    )
+    accumulator = ConnectomeAccumulator([g], error_margin=0, overlap_thr=2)
+    for start in range(0, len(tracks), 64):
+        accumulator.add(tracks[start : start + 64])
+
+    assert accumulator.n_streamlines == len(tracks)
+    (conn_matrix,) = accumulator.conn_matrices()
+    assert g.conn_matrix is conn_matrix
+    assert np.array_equal(
+        conn_matrix.toarray(), reference_connectome(tracks, rois, attr, 2)
+    )
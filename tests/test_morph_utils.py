@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from m2g.utils import morph_utils
+from m2g.utils.reg_utils import erode_mask
+
+
+def reference_erosion(mask, v):
+    """Per-voxel erosion over the 6 face neighbours, as m2g used to compute it."""
+    md = mask.shape
+    for _ in range(v):
+        eroded = np.zeros(md)
+        for x, y, z in zip(*np.where(mask != 0)):
+            if (
+                mask[min(x + 1, md[0] - 1), y, z]
+                and mask[x, min(y + 1, md[1] - 1), z]
+                and mask[x, y, min(z + 1, md[2] - 1)]
+                and mask[max(x - 1, 0), y, z]
+                and mask[x, max(y - 1, 0), z]
+                and mask[x, y, max(z - 1, 0)]
+            ):
+                eroded[x, y, z] = 1
+        mask = eroded
+    return mask
+
+
+@pytest.fixture
+def mask():
+    rng = np.random.default_rng(0)
+    mask = rng.random((16, 18, 14)) > 0.15
+    mask[:, :, :2] = True  # touching the border of the volume
+    return mask
+
+
+@pytest.mark.parametrize("v", [0, 1, 2])
+def test_erode_mask(mask, v):
+    assert np.array_equal(erode_mask(mask, v=v), reference_erosion(mask, v))
+
+
+def test_edge_and_dilate(mask):
+    edge = morph_utils.edge(mask)
+    assert np.array_equal(edge, mask & (reference_erosion(mask, 1) == 0))
+    assert np.array_equal(morph_utils.dilate(~mask), ~morph_utils.erode(mask))
+
+
+def test_sphere_kernel():
+    kernel = morph_utils.sphere_kernel(10, (2.0, 2.0, 4.0, 1.0))
+    assert kernel.shape == (11, 11, 5)
+    assert kernel[5, 5, 2] and kernel[0, 5, 2] and kernel[5, 5, 0]
+    assert not kernel[0, 0, 2]
+    assert kernel is morph_utils.sphere_kernel(10, (2, 2, 4))
+
+    i, j, k = np.indices((40, 40, 40))
+    ball = (i - 20) ** 2 + (j - 20) ** 2 + (k - 20) ** 2 <= 8**2
+    eroded = morph_utils.erode_sphere(ball, 10, (2, 2, 2))
+    assert np.array_equal(eroded, (i - 20) ** 2 + (j - 20) ** 2 + (k - 20) ** 2 <= 3**2)
+
+    point = np.zeros((40, 40, 40), bool)
+    point[20, 20, 20] = True
+    dilated = morph_utils.dilate_sphere(point, 10, (2, 2, 2))
+    assert np.array_equal(
+        dilated, (i - 20) ** 2 + (j - 20) ** 2 + (k - 20) ** 2 <= 5**2
+    )
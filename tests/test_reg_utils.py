@@ -0,0 +1,159 @@
+import nibabel as nib
+import nilearn.image as nl
+import numpy as np
+import pytest
+
+from m2g.utils.reg_utils import (
+    fsl_scaled_voxels,
+    fsl_vox2vox,
+    resample_volumes,
+    transfer_xfm,
+)
+
+# a radiological (LAS) reference, like FSL's MNI template, and inputs on a finer RAS grid
+REF_AFFINE = np.array(
+    [[-2.0, 0, 0, 31.3], [0, 2.0, 0, -40], [0, 0, 2.0, -20], [0, 0, 0, 1]]
+)
+INP_AFFINE = np.array(
+    [[1.5, 0, 0, -30], [0, 1.5, 0, -37], [0, 0, 1.5, -25], [0, 0, 0, 1]]
+)
+
+# flirt moves 4 mm along x and -2 mm along y in its scaled voxel coordinates: voxel indices times voxel
+# sizes, with the x index reversed for images with a positive (neurological) affine determinant.
+# The images' origins play no part in them
+FLIRT_XFM = np.array([[1.0, 0, 0, 4], [0, 1, 0, -2], [0, 0, 1, 0], [0, 0, 0, 1]])
+# neurological input of 10 x 8 x 6 voxels of 2 mm: voxel (i, j, k) is at (2 (9 - i), 2 j, 2 k)
+FLIRT_INP_AFFINE = np.array(
+    [[2.0, 0, 0, -9], [0, 2.0, 0, 4], [0, 0, 2.0, 7], [0, 0, 0, 1]]
+)
+# radiological reference of 1 x 2 x 2 mm voxels: voxel (i, j, k) is at (i, 2 j, 2 k)
+FLIRT_REF_AFFINE = np.array(
+    [[-1.0, 0, 0, 30], [0, 2.0, 0, -3], [0, 0, 2.0, 0], [0, 0, 0, 1]]
+)
+
+
+def world_identity_xfm(inp_img, ref_img):
+    """flirt matrix mapping each world coordinate onto itself"""
+    return (
+        fsl_scaled_voxels(ref_img)
+        @ np.linalg.inv(ref_img.affine)
+        @ inp_img.affine
+        @ np.linalg.inv(fsl_scaled_voxels(inp_img))
+    )
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    ref = nib.Nifti1Image(np.zeros((30, 34, 28), np.float32), REF_AFFINE)
+    labels = nib.Nifti1Image(
+        rng.integers(0, 50, (40, 44, 38)).astype(np.int16), INP_AFFINE
+    )
+    prob = nib.Nifti1Image(rng.random((40, 44, 38)).astype(np.float32), INP_AFFINE)
+    paths = {}
+    for name, img in [("ref", ref), ("labels", labels), ("prob", prob)]:
+        paths[name] = str(tmp_path / f"{name}.nii.gz")
+        nib.save(img, paths[name])
+    paths["xfm"] = str(tmp_path / "xfm.mat")
+    np.savetxt(paths["xfm"], world_identity_xfm(labels, ref))
+    return tmp_path, ref, labels, prob, paths
+
+
+def test_resample_volumes(images):
+    tmp_path, ref, labels, prob, paths = images
+    outputs = [str(tmp_path / "labels_out.nii.gz"), str(tmp_path / "prob_out.nii.gz")]
+
+    resample_volumes(
+        paths["ref"], paths["labels"], paths["xfm"], outputs[0], "nearestneighbour"
+    )
+    resample_volumes(paths["ref"], [paths["prob"]], paths["xfm"], outputs[1:])
+
+    aligned = nib.load(outputs[0])
+    expected = nl.resample_img(labels, ref.affine, ref.shape, interpolation="nearest")
+    assert aligned.get_data_dtype() == np.int16
+    assert np.allclose(aligned.affine, ref.affine)
+    assert np.array_equal(np.asanyarray(aligned.dataobj), expected.get_fdata())
+
+    aligned = nib.load(outputs[1])
+    expected = nl.resample_img(prob, ref.affine, ref.shape, interpolation="linear")
+    assert np.allclose(aligned.get_fdata(), expected.get_fdata(), atol=1e-6)
+
+    # kept in memory, without saving
+    (in_memory,) = resample_volumes(paths["ref"], paths["prob"], paths["xfm"])
+    assert np.array_equal(in_memory.get_fdata(), aligned.get_fdata())
+
+    with pytest.raises(ValueError):
+        resample_volumes(paths["ref"], paths["prob"], paths["xfm"], outputs[1], "sinc")
+
+
+def test_transfer_xfm(images):
+    tmp_path, ref, labels, prob, paths = images
+    # the same world space as labels, reoriented and cropped
+    cropped = nib.as_closest_canonical(labels).slicer[5:30, 3:40, 2:35]
+    cropped_file = str(tmp_path / "cropped.nii.gz")
+    nib.save(cropped, cropped_file)
+
+    xfm_out = str(tmp_path / "cropped.mat")
+    transfer_xfm(paths["xfm"], paths["labels"], cropped_file, xfm_out)
+    assert np.allclose(np.loadtxt(xfm_out), world_identity_xfm(cropped, ref))
+
+
+@pytest.fixture
+def flirt_images(tmp_path):
+    inp = nib.Nifti1Image(
+        np.arange(10 * 8 * 6, dtype=np.int16).reshape(10, 8, 6), FLIRT_INP_AFFINE
+    )
+    ref = nib.Nifti1Image(np.zeros((12, 8, 6), np.float32), FLIRT_REF_AFFINE)
+    paths = {}
+    for name, img in [("inp", inp), ("ref", ref)]:
+        paths[name] = str(tmp_path / f"flirt_{name}.nii.gz")
+        nib.save(img, paths[name])
+    paths["xfm"] = str(tmp_path / "flirt.mat")
+    np.savetxt(paths["xfm"], FLIRT_XFM)
+    return tmp_path, inp, ref, paths
+
+
+def test_flirt_convention(flirt_images):
+    tmp_path, inp, ref, paths = flirt_images
+    # reference voxel (i, j, k) -> (i, 2 j, 2 k) -> flirt -> (i - 4, 2 j + 2, 2 k) -> input voxel
+    # (9 - (i - 4) / 2, j + 1, k)
+    expected = np.array(
+        [[-0.5, 0, 0, 11], [0, 1.0, 0, 1], [0, 0, 1.0, 0], [0, 0, 0, 1]]
+    )
+    assert np.allclose(fsl_vox2vox(FLIRT_XFM, inp, ref), expected)
+
+    (aligned,) = resample_volumes(
+        paths["ref"], paths["inp"], paths["xfm"], interp="nearestneighbour"
+    )
+    aligned = np.asanyarray(aligned.dataobj)
+    data = np.asanyarray(inp.dataobj)
+    for i in range(4, 12, 2):
+        for j in range(7):
+            assert np.array_equal(aligned[i, j], data[9 - (i - 4) // 2, j + 1])
+    assert not aligned[:4].any()
+
+
+def test_transfer_xfm_flirt_convention(flirt_images):
+    tmp_path, inp, ref, paths = flirt_images
+    data = np.asanyarray(inp.dataobj)
+    xfm_out = str(tmp_path / "new.mat")
+
+    # stored radiologically: voxel i of the flipped image is voxel 9 - i of the input, at 2 i either way
+    flipped = nib.Nifti1Image(
+        data[::-1],
+        FLIRT_INP_AFFINE
+        @ np.array([[-1.0, 0, 0, 9], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]),
+    )
+    flipped_file = str(tmp_path / "flipped.nii.gz")
+    nib.save(flipped, flipped_file)
+    transfer_xfm(paths["xfm"], paths["inp"], flipped_file, xfm_out)
+    assert np.allclose(np.loadtxt(xfm_out), FLIRT_XFM)
+
+    # cropped by 2 voxels in x and 1 in y: voxel (i, j, k) is at (2 (7 - i), 2 j, 2 k), 2 mm short of
+    # the input along y, which the transform makes up for
+    cropped = inp.slicer[2:, 1:]
+    cropped_file = str(tmp_path / "cropped_inp.nii.gz")
+    nib.save(cropped, cropped_file)
+    transfer_xfm(paths["xfm"], paths["inp"], cropped_file, xfm_out)
+    expected = np.array([[1.0, 0, 0, 4], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    assert np.allclose(np.loadtxt(xfm_out), expected)
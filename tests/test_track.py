@@ -0,0 +1,219 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.direction import peaks_from_model
+from dipy.reconst.shm import CsaOdfModel
+from dipy.sims.voxel import single_tensor
+
+from m2g import track
+from m2g.track import (
+    PEAKS_PARAMS,
+    MaskedDWI,
+    RunTrack,
+    build_seed_list,
+    fit_peaks,
+    fit_shm,
+)
+
+SHAPE = (40, 10, 10)
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+@pytest.fixture
+def dwi_files(tmp_path):
+    """Synthetic acquisition of a white matter bundle running along x"""
+    bvecs = np.vstack([[0, 0, 0], get_sphere("repulsion100").vertices[:60]])
+    gtab = gradient_table(np.r_[0, np.full(60, 1000.0)], bvecs)
+    signal = single_tensor(
+        gtab, S0=100, evals=np.array([1.7e-3, 0.3e-3, 0.3e-3]), evecs=np.eye(3)
+    )
+    rng = np.random.default_rng(0)
+    dwi = signal + rng.normal(0, 1, SHAPE + (len(signal),))
+
+    mask = np.zeros(SHAPE)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    wm = np.zeros(SHAPE)
+    wm[2:38, 3:7, 3:7] = 1
+    gm = np.zeros(SHAPE)
+    gm[1] = 1
+
+    files = {}
+    for name, data in [
+        ("dwi_in", dwi),
+        ("nodif_B0_mask", mask),
+        ("gm_in_dwi", gm),
+        ("vent_csf_in_dwi", np.zeros(SHAPE)),
+        ("csf_in_dwi", np.zeros(SHAPE)),
+        ("wm_in_dwi", wm),
+    ]:
+        files[name] = str(tmp_path / f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data.astype(np.float32), AFFINE), files[name])
+    return files, gtab
+
+
+def make_track(dwi_files, mod_type="det", seeds=None, track_type="local", **kwargs):
+    files, gtab = dwi_files
+    if seeds is None:
+        seeds = build_seed_list(files["wm_in_dwi"], np.eye(4), 1, random_seed=0)
+    return RunTrack(
+        **files,
+        gtab=gtab,
+        mod_type=mod_type,
+        track_type=track_type,
+        mod_func="csa",
+        qa_tensor_out=None,
+        seeds=seeds,
+        stream_affine=np.eye(4),
+        **kwargs,
+    )
+
+
+def run_track(dwi_files, mod_type="det", seeds=None, **kwargs):
+    trct = make_track(dwi_files, mod_type, seeds, **kwargs)
+    return trct, trct.run()
+
+
+def assert_same_streamlines(a, b):
+    assert len(a) == len(b) > 0
+    for sa, sb in zip(a, b):
+        assert np.array_equal(sa, sb)
+
+
+@pytest.mark.parametrize("mod_type", ["det", "prob"])
+def test_sharded_tracking(dwi_files, mod_type):
+    _, serial = run_track(dwi_files, mod_type, n_cpus=1, random_seed=1)
+    _, sharded = run_track(dwi_files, mod_type, n_cpus=2, random_seed=1)
+    assert_same_streamlines(serial, sharded)
+
+
+def test_sharded_tracking_without_random_seed(dwi_files):
+    # every shard is seeded from its index, so sharded runs are reproducible
+    _, first = run_track(dwi_files, "prob", n_cpus=2)
+    _, second = run_track(dwi_files, "prob", n_cpus=2)
+    assert_same_streamlines(first, second)
+
+
+def test_save_tracks(dwi_files, tmp_path):
+    files, _ = dwi_files
+    trct, streamlines = run_track(dwi_files, random_seed=1)
+    hdr = nib.load(files["dwi_in"]).header
+    trk_file = trct.save_tracks(str(tmp_path / "streamlines.trk"), hdr, batch_size=100)
+
+    trk = nib.streamlines.load(trk_file)
+    assert trk.header["nb_streamlines"] == len(streamlines)
+    assert np.array_equal(trk.header["dimensions"], SHAPE)
+    assert np.allclose(trk.header["voxel_sizes"], 2.0)
+    assert trk.header["voxel_order"] == b"RAS"
+    assert len(trk.streamlines) == len(streamlines)
+    for loaded, tracked in zip(trk.streamlines, streamlines):
+        assert np.allclose(loaded, tracked, atol=1e-5)
+
+
+@pytest.mark.parametrize("cache_float32", [False, True])
+def test_model_cache(dwi_files, tmp_path, monkeypatch, cache_float32):
+    cache_dir = str(tmp_path / "tensor")
+    os.makedirs(cache_dir)
+    cached_run = dict(cache_dir=cache_dir, cache_float32=cache_float32, random_seed=1)
+    trct, fresh = run_track(dwi_files, **cached_run)
+    (cache_file,) = trct.cache_files("peaks")
+    dtype = np.float32 if cache_float32 else np.float64
+    with np.load(cache_file) as cache:
+        assert cache["peak_dirs"].dtype == cache["shm_coeff"].dtype == dtype
+    if not cache_float32:
+        # the cache leaves the fit at full precision
+        _, uncached = run_track(dwi_files, random_seed=1)
+        assert_same_streamlines(fresh, uncached)
+
+    def refit(*args, **kwargs):
+        raise AssertionError("the model was fit again")
+
+    # reruns track from the cached peaks, exactly like the fresh fit did
+    monkeypatch.setattr(track, "fit_peaks", refit)
+    _, cached = run_track(dwi_files, **cached_run)
+    assert_same_streamlines(fresh, cached)
+
+    # probabilistic tracking takes the coefficients from the cached peaks
+    monkeypatch.setattr(track, "fit_shm", refit)
+    _, prob = run_track(dwi_files, "prob", **cached_run)
+    assert len(prob) > 0
+
+
+def test_peaks_key(dwi_files, tmp_path):
+    files, gtab = dwi_files
+
+    def peaks_key(files, gtab):
+        trct = make_track((files, gtab))
+        trct.prep_tracking()
+        return trct.peaks_key()
+
+    key = peaks_key(files, gtab)
+    assert peaks_key(files, gtab) == key
+
+    # a different gradient table
+    other_gtab = gradient_table(gtab.bvals * 1.2, gtab.bvecs)
+    assert peaks_key(files, other_gtab) != key
+
+    # a different white matter mask
+    wm = nib.load(files["wm_in_dwi"])
+    data = wm.get_fdata()
+    data[20, 4, 4] = 0
+    other_files = dict(files, wm_in_dwi=str(tmp_path / "other_wm.nii.gz"))
+    nib.save(nib.Nifti1Image(data, wm.affine), other_files["wm_in_dwi"])
+    assert peaks_key(other_files, gtab) != key
+
+
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_fit_peaks(dwi_files, n_cpus):
+    files, gtab = dwi_files
+    wm = nib.load(files["wm_in_dwi"]).get_fdata() > 0
+    data = nib.load(files["dwi_in"]).get_fdata()
+    model = CsaOdfModel(gtab, sh_order=6)
+    sphere = get_sphere("repulsion724")
+    expected = peaks_from_model(
+        model, data, sphere, mask=wm, return_sh=True, **PEAKS_PARAMS
+    )
+
+    dwi = MaskedDWI(files["dwi_in"], wm)
+    assert dwi.data.shape == (wm.sum(), data.shape[-1])
+    pam = fit_peaks(model, dwi, sphere, n_cpus=n_cpus)
+    for field in ["peak_dirs", "peak_values", "gfa", "qa", "shm_coeff"]:
+        assert np.allclose(getattr(pam, field), getattr(expected, field))
+    assert np.array_equal(pam.peak_indices, expected.peak_indices)
+    assert np.allclose(fit_shm(model, dwi, n_cpus=n_cpus), expected.shm_coeff)
+
+
+@pytest.mark.parametrize(
+    "mod_type,track_type", [("det", "local"), ("prob", "local"), ("det", "particle")]
+)
+def test_cropped_tracking(dwi_files, mod_type, track_type, tmp_path, monkeypatch):
+    files, gtab = dwi_files
+    # surrounds the acquisition with empty voxels for the tracking to crop away
+    padded = {}
+    for name, path in files.items():
+        img = nib.load(path)
+        pad = [(3, 3)] * 3 + [(0, 0)] * (img.ndim - 3)
+        padded[name] = str(tmp_path / f"padded_{name}.nii.gz")
+        nib.save(nib.Nifti1Image(np.pad(img.get_fdata(), pad), AFFINE), padded[name])
+    seeds = build_seed_list(padded["wm_in_dwi"], np.eye(4), 1, random_seed=0)
+    padded_shape = tuple(n + 6 for n in SHAPE)
+
+    trct, cropped = run_track(
+        (padded, gtab), mod_type, seeds, track_type=track_type, random_seed=1
+    )
+    assert all(c < n for c, n in zip(trct.mask.shape, padded_shape))
+    assert np.abs(trct.track_seeds() - seeds).max() <= 2.0**-17
+
+    monkeypatch.setattr(
+        track, "bounding_box", lambda *masks, pad=1: (slice(0, None),) * 3
+    )
+    trct, whole = run_track(
+        (padded, gtab), mod_type, seeds, track_type=track_type, random_seed=1
+    )
+    assert trct.mask.shape == padded_shape
+    assert len(cropped) == len(whole) > 0
+    for sc, sw in zip(cropped, whole):
+        assert np.allclose(sc, sw)